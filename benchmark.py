@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from pos_data import read
+from models.simple import Simple
+from models.hmm import HMM
+from models.complex import Complex
+
+
+"""
+Measures speed and memory of models
+
+For every dataset and model, fits the model and predicts the dataset in a fresh process, and reports
+fit time, throughput in tokens/sec, per-sentence latency percentiles, peak RSS and size of fitted model on disk.
+Results are written as JSON, so runs can be diffed to catch performance regressions.
+
+Usage:
+./benchmark.py --datasets bc.val train.txt synthetic --models simple hmm complex --output bench.json
+"""
+
+MODELS = {'simple': Simple, 'hmm': HMM, 'complex': Complex}
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+DATASETS = {
+    'bc.val': (os.path.join(DATA_DIR, 'bc.val'), 'line'),
+    'train.txt': (os.path.join(DATA_DIR, 'train.txt'), 'column'),
+}
+
+
+"""
+Generates a random corpus from a random first order Markov chain over tags, where each tag emits words from its
+own Zipf distributed vocabulary
+
+Input
+num_sentences: number of sentences
+sentence_length: average length of sentence
+num_tags: number of tags
+vocabulary_size: number of words of each tag
+seed: seed of random number generator
+
+Output
+X, y in the same form as returned by pos_data.read
+"""
+
+
+def synthetic_corpus(num_sentences, sentence_length, num_tags=12, vocabulary_size=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    transition = rng.dirichlet(np.full(num_tags, 0.3), num_tags)
+    lengths = np.maximum(1, rng.poisson(sentence_length, num_sentences))
+
+    X, y = [], []
+    for length in lengths:
+        tags = np.empty(length, dtype=np.intp)
+        tags[0] = rng.integers(num_tags)
+        for i in range(1, length):
+            tags[i] = rng.choice(num_tags, p=transition[tags[i - 1]])
+        words = np.minimum(rng.zipf(1.3, length), vocabulary_size)
+        X.append(['w{}_{}'.format(t, w) for (t, w) in zip(tags, words)])
+        y.append(['t{}'.format(t) for t in tags])
+    return X, y
+
+
+def load_dataset(name, args):
+    if name == 'synthetic':
+        return synthetic_corpus(args.synthetic_sentences, args.synthetic_length, args.synthetic_tags,
+                                args.synthetic_vocabulary)
+    path, fmt = DATASETS[name]
+    return read(path, 'train', fmt)
+
+
+"""
+Runs one benchmark, meant to run in a fresh process so that peak RSS belongs to this model only
+"""
+
+
+def run(dataset, model_name, args):
+    X, y = load_dataset(dataset, args)
+    X_test = X[:args.max_sentences] if args.max_sentences else X
+    num_tokens = sum(len(sample) for sample in X_test)
+
+    model = MODELS[model_name]()
+    if model_name == 'complex':
+        model.DECODER = args.complex_decoder
+
+    start = time.perf_counter()
+    model.fit(X, y)
+    # costs are derived lazily, include that in fit time
+    model.predict(X[:1])
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model.predict(X_test)
+    predict_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model.predict_batch(X_test)
+    predict_batch_seconds = time.perf_counter() - start
+
+    latencies = []
+    for sample in X_test[:args.latency_sentences]:
+        start = time.perf_counter()
+        model.predict([sample])
+        latencies.append(time.perf_counter() - start)
+
+    model_dir = tempfile.mkdtemp()
+    try:
+        model.save(model_dir)
+        model_bytes = sum(os.path.getsize(os.path.join(model_dir, f)) for f in os.listdir(model_dir))
+    finally:
+        shutil.rmtree(model_dir)
+
+    return {
+        'dataset': dataset,
+        'model': model_name,
+        'train_sentences': len(X),
+        'test_sentences': len(X_test),
+        'test_tokens': num_tokens,
+        'num_tags': len(model.tagIndex),
+        'vocabulary_size': len(model.vocabulary),
+        'fit_seconds': fit_seconds,
+        'predict_seconds': predict_seconds,
+        'predict_tokens_per_second': num_tokens / predict_seconds,
+        'predict_batch_seconds': predict_batch_seconds,
+        'predict_batch_tokens_per_second': num_tokens / predict_batch_seconds,
+        'latency_ms': {'p50': float(np.percentile(latencies, 50) * 1000),
+                       'p95': float(np.percentile(latencies, 95) * 1000),
+                       'p99': float(np.percentile(latencies, 99) * 1000)},
+        # ru_maxrss is in kilobytes on linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'model_bytes': model_bytes,
+    }
+
+
+def _run_in_child(results, dataset, model_name, args):
+    try:
+        results.put(run(dataset, model_name, args))
+    except Exception as e:
+        results.put({'dataset': dataset, 'model': model_name, 'error': '{}: {}'.format(type(e).__name__, e)})
+
+
+"""
+Runs one benchmark in a fresh process and waits for its result, reports an error entry if the process fails
+without sending one
+"""
+
+
+def run_isolated(context, dataset, model_name, args):
+    results = context.Queue()
+    process = context.Process(target=_run_in_child, args=(results, dataset, model_name, args))
+    process.start()
+    try:
+        while True:
+            try:
+                return results.get(timeout=1.0)
+            except queue.Empty:
+                if not process.is_alive():
+                    # result may have arrived just before the process exited
+                    try:
+                        return results.get(timeout=1.0)
+                    except queue.Empty:
+                        pass
+                    return {'dataset': dataset, 'model': model_name,
+                            'error': 'benchmark process exited with code {}'.format(process.exitcode)}
+    finally:
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fit and predict of models')
+    parser.add_argument('--datasets', nargs='+', default=['bc.val', 'train.txt'],
+                        choices=list(DATASETS) + ['synthetic'])
+    parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    parser.add_argument('--complex-decoder', default='gibbs', choices=['gibbs', 'viterbi', 'beam'])
+    parser.add_argument('--max-sentences', type=int, default=None, help='predict at most this many sentences')
+    parser.add_argument('--latency-sentences', type=int, default=500,
+                        help='number of sentences predicted one by one to measure latency')
+    parser.add_argument('--synthetic-sentences', type=int, default=10000)
+    parser.add_argument('--synthetic-length', type=int, default=15)
+    parser.add_argument('--synthetic-tags', type=int, default=12)
+    parser.add_argument('--synthetic-vocabulary', type=int, default=2000, help='number of words of each tag')
+    parser.add_argument('--output', default=None, help='JSON file to write results to, default is stdout')
+    args = parser.parse_args()
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for dataset in args.datasets:
+        for model_name in args.models:
+            results.append(run_isolated(context, dataset, model_name, args))
+
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'args': vars(args),
+        'results': results,
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = [result for result in results if 'error' in result]
+    for result in failed:
+        print('{} on {} failed: {}'.format(result['model'], result['dataset'], result['error']), file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from itertools import product
+
+import numpy as np
+
+from pos_data import read
+from metrics import Accumulator
+from crossval import cross_validate, fold_ranges
+from models.probabilistic import Probabilistic
+from models.statistics import Statistics
+from models.simple import Simple
+from models.hmm import HMM
+from models.complex import Complex
+import server
+
+
+"""
+Correctness checks that are too slow or too involved to run on every call, run them after changing the models or
+the server. Every check raises Exception describing the first mismatch it finds
+
+Usage:
+./check.py            runs all checks
+./check.py server     runs only the named checks
+"""
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'bc.val')
+
+
+def _expect(condition, message, *args):
+    if not condition:
+        raise Exception(message.format(*args))
+
+
+"""
+Output
+model of model_class fitted on all but first 200 sentences of DATA, and those 200 sentences as test set
+"""
+
+
+def _fit(model_class):
+    X, y = read(DATA, 'train')
+    model = model_class()
+    model.fit(X[200:], y[200:])
+    return model, X[:200]
+
+
+"""
+Output
+every model to check predictions of: Simple, HMM, and Complex decoding with Gibbs sampling (seeded), second order
+Viterbi and beam search
+"""
+
+
+def _models():
+    complex_params = [{'DECODER': 'gibbs', 'SEED': 0, 'NUM_GIBBS_ITER': 20}, {'DECODER': 'viterbi'},
+                      {'DECODER': 'beam'}]
+    models = [Simple(), HMM()] + [Complex() for _ in complex_params]
+    for model, params in zip(models[2:], complex_params):
+        vars(model).update(params)
+    return models
+
+
+"""
+Checks that predict_parallel gives the same tags as predict for every model, with chunks smaller than the input
+so that it is split among workers
+"""
+
+
+def check_parallel():
+    X, y = read(DATA, 'train')
+    for model in _models():
+        model.fit(X[200:], y[200:])
+        _expect(model.predict_parallel(X[:100], n_jobs=2, chunk_size=16) == model.predict(X[:100]),
+                'Tags of predict_parallel of {} differ from predict', _describe(model))
+
+
+"""
+Checks that a model loaded from what save wrote gives the same tags and costs as the saved one, for every model and
+for compact storage options (float32 costs, sparse trigrams, sparse emission table, tag dictionary), and that only
+the costs the model uses are saved
+"""
+
+
+def check_storage():
+    X, y = read(DATA, 'train')
+    models = _models()
+    compact = Complex()
+    vars(compact).update({'DECODER': 'viterbi', 'COST_DTYPE': 'float32', 'SPARSE_TRIGRAMS': True,
+                          'MAX_DENSE_EMISSION_CELLS': 0, 'TAG_DICTIONARY': True})
+    for model in models + [compact]:
+        model.fit(X[200:], y[200:])
+        expected = model.predict(X[:100])
+        with tempfile.TemporaryDirectory() as path:
+            model.save(path)
+            saved = {name.split('.')[0] for name in os.listdir(path)}
+            for mmap_mode in ['r', None]:
+                loaded = Probabilistic.load(path, mmap_mode)
+                _expect(type(loaded) is type(model), 'Loaded {} as {}', _describe(model), type(loaded).__name__)
+                _expect(loaded.predict(X[:100]) == expected, 'Tags of loaded {} differ', _describe(model))
+                for name in model._cost_names():
+                    _expect(_same_cost(getattr(loaded, name), getattr(model, name)), '{} of loaded {} differs', name,
+                            _describe(model))
+        unused = {'tag_cost', 'beginning_cost', 'transition_1_cost', 'transition_2_cost'} - set(model._cost_names())
+        _expect(not any(name.startswith(tuple(unused)) for name in saved), 'Saved {} has unused costs {}',
+                _describe(model), sorted(saved))
+
+
+"""
+Checks that sparse trigram table (SPARSE_TRIGRAMS) and sparse emission table (MAX_DENSE_EMISSION_CELLS) hold the
+same costs as dense arrays, looked up at once, one by one and as whole rows, and that they give the same tags
+"""
+
+
+def check_sparse():
+    X, y = read(DATA, 'train')
+    dense = Complex()
+    dense.fit(X[200:], y[200:])
+    sparse = Complex()
+    vars(sparse).update({'SPARSE_TRIGRAMS': True, 'MAX_DENSE_EMISSION_CELLS': 0})
+    sparse.fit(X[200:], y[200:])
+    num_tags, num_words = len(dense.tagIndex), len(dense.vocabulary)
+
+    table = sparse.transition_2_cost
+    _expect(type(table).__name__ == 'SparseTrigramTable', 'Trigram table is {}', type(table).__name__)
+    _expect(np.array_equal(table.dense(), dense.transition_2_cost), 'Sparse trigram costs differ from dense')
+    triples = np.random.default_rng(0).integers(num_tags, size=(3, 1000))
+    _expect(np.array_equal(sparse.transition_2_lookup(*triples), dense.transition_2_lookup(*triples)),
+            'Sparse trigram lookup differs from dense')
+    for triple in triples.T[:100]:
+        _expect(sparse.get_transition_2_cost(*triple) == dense.get_transition_2_cost(*triple),
+                'Transition cost of {} differs', triple)
+
+    emission = sparse.emission_cost
+    _expect(type(emission).__name__ == 'SparseEmissionTable', 'Emission table is {}', type(emission).__name__)
+    word_ids = np.arange(num_words + 1)
+    _expect(np.array_equal(emission.rows(word_ids), dense.emission_cost.rows(word_ids)),
+            'Sparse emission rows differ from dense')
+    for word_id, tag in zip(word_ids[::50], triples[0]):
+        _expect(emission.get(word_id, tag) == dense.emission_cost.get(word_id, tag),
+                'Emission cost of word {} and tag {} differs', word_id, tag)
+
+    for params in [{'DECODER': 'viterbi'}, {'DECODER': 'gibbs', 'SEED': 0, 'NUM_GIBBS_ITER': 20}]:
+        vars(dense).update(params)
+        vars(sparse).update(params)
+        _expect(sparse.predict_batch(X[:100]) == dense.predict_batch(X[:100]), 'Tags of sparse tables differ with {}',
+                params)
+
+
+"""
+Checks that cross_validate, which trains on counts of whole corpus minus counts of a fold, gives the same accuracy
+of every fold and setting as a model fitted from scratch on all the other folds
+"""
+
+
+def check_crossval():
+    X, y = read(DATA, 'train')
+    X, y = X[:900], y[:900]
+    grid = {'MISSING_EMISSION_COST': [10.0, 20.0], 'DECODER': ['viterbi', 'beam']}
+    results = cross_validate(HMM, X, y, grid, folds=3, n_jobs=2)
+
+    for result in results:
+        accumulator = Accumulator()
+        for i, (start, end) in enumerate(fold_ranges(len(X), 3)):
+            model = HMM()
+            vars(model).update(result['params'])
+            model.fit(X[:start] + X[end:], y[:start] + y[end:])
+            fold = Accumulator()
+            fold.update(y[start:end], model.predict_batch(X[start:end]))
+            accumulator.merge(fold)
+            _expect(fold.result()['word_accuracy'] == result['fold_word_accuracy'][i],
+                    'Accuracy of fold {} with {} is {}, refitted model has {}', i, result['params'],
+                    result['fold_word_accuracy'][i], fold.result()['word_accuracy'])
+        _expect(accumulator.result()['word_accuracy'] == result['word_accuracy'],
+                'Accuracy of all folds with {} differs from refitted models', result['params'])
+
+
+def _same_cost(a, b):
+    if a is None or b is None:
+        return a is None and b is None
+    if isinstance(a, np.ndarray):
+        return np.array_equal(a, b)
+    if hasattr(a, '__dict__'):
+        return type(a) is type(b) and vars(a).keys() == vars(b).keys() and all(
+            _same_cost(vars(a)[k], vars(b)[k]) for k in vars(a))
+    return a == b
+
+
+def _describe(model):
+    if not hasattr(model, 'DECODER'):
+        return type(model).__name__
+    return '{} with {} decoder'.format(type(model).__name__, model.DECODER)
+
+
+"""
+Checks that the Gibbs distribution of every word computed from its Markov blanket equals the one computed from the
+full posterior of the sentence with only the tag of that word changed, for random tags of the test sentences
+"""
+
+
+def check_blanket():
+    model, X_test = _fit(Complex)
+    rng = np.random.default_rng(0)
+    num_tags = len(model.tagIndex)
+
+    for sentence in X_test[:50]:
+        emission = model.emission_matrix(sentence)[np.newaxis]
+        tags = rng.integers(num_tags, size=(1, len(sentence)))
+        blanket = model._calculate_probability_dist(tags, emission, np.arange(len(sentence))[np.newaxis])[0]
+
+        for k in range(len(sentence)):
+            posterior = np.empty(num_tags)
+            for t in range(num_tags):
+                changed = tags[0].copy()
+                changed[k] = t
+                posterior[t] = model._calculate_posterior(changed, sentence)
+            full = np.exp(-(posterior - np.min(posterior)))
+            full /= np.sum(full)
+            error = np.max(np.abs(blanket[k] - full))
+            _expect(error < 1e-9, 'Blanket distribution of word {} of {} differs by {}', k, sentence, error)
+
+
+"""
+Output
+dict of every kind of count of statistics, counts keyed by words and tags instead of their ids, counts of 0 left out,
+so statistics that index words and tags in different order compare equal
+"""
+
+
+def _counts(statistics):
+    tags = list(statistics.tagIndex)
+    words = list(statistics.vocabulary)
+
+    def named(keys, count):
+        return {key: int(c) for (key, c) in zip(keys, count) if c != 0}
+
+    bigrams = np.nonzero(statistics.bigram_count)
+    return {
+        'tag': named(tags, statistics.tag_count),
+        'start': named(tags, statistics.start_count),
+        'bigram': named([(tags[t], tags[p]) for (t, p) in zip(*bigrams)], statistics.bigram_count[bigrams]),
+        'trigram': named([(tags[t], tags[p], tags[pp]) for (t, p, pp) in zip(statistics.trigram_tag_i,
+                                                                               statistics.trigram_tag_i_1,
+                                                                               statistics.trigram_tag_i_2)],
+                         statistics.trigram_count),
+        'emission': named([(words[w], tags[t]) for (w, t) in zip(statistics.emission_words, statistics.emission_tags)],
+                          statistics.emission_count),
+    }
+
+
+"""
+Checks that fitting a corpus in parts with partial_fit or merging statistics of parts gives the same counts and
+costs as fitting it at once, and that subtracting statistics of a part gives the counts of the rest
+"""
+
+
+def check_statistics():
+    X, y = read(DATA, 'train')
+    parts = [(X[start:start + 500], y[start:start + 500]) for start in range(0, len(X), 500)]
+    whole = Statistics()
+    whole.partial_fit(X, y)
+
+    model = HMM()
+    model.fit(X, y)
+    incremental = HMM()
+    for X_part, y_part in parts:
+        incremental.partial_fit(X_part, y_part)
+    _expect(_counts(incremental.statistics) == _counts(whole), 'Counts of partial_fit differ from fit')
+    for name in ['beginning_cost', 'transition_1_cost', 'transition_2_cost']:
+        _expect(np.array_equal(getattr(incremental, name), getattr(model, name)), '{} of partial_fit differs', name)
+    _expect(incremental.predict(X[:200]) == model.predict(X[:200]), 'Tags of partial_fit differ from fit')
+
+    merged = Statistics()
+    part_statistics = []
+    for X_part, y_part in parts:
+        part_statistics.append(Statistics())
+        part_statistics[-1].partial_fit(X_part, y_part)
+        merged.merge(part_statistics[-1])
+    _expect(_counts(merged) == _counts(whole), 'Counts of merged parts differ from counts of whole corpus')
+
+    rest = Statistics()
+    rest.partial_fit(X[500:], y[500:])
+    subtracted = whole.copy()
+    subtracted.subtract(part_statistics[0])
+    _expect(_counts(subtracted) == _counts(rest), 'Counts of whole corpus minus first part differ from the rest')
+    subtracted.merge(part_statistics[0])
+    _expect(_counts(subtracted) == _counts(whole), 'Subtracting and merging back a part changes counts')
+
+
+"""
+Input
+model: fitted HMM for order 1, or Complex for order 2
+emission: (number of words x number of tags) matrix of emission costs of a sentence
+order: number of previous tags the transition depends on
+
+Output
+array of every tag sequence of the sentence, one per row, and array of their costs, -log of joint probability of
+sequence and sentence (see Complex._calculate_posterior)
+"""
+
+
+def _all_sequences(model, emission, order):
+    num_words, num_tags = emission.shape
+    sequences = np.array(list(product(range(num_tags), repeat=num_words)), dtype=np.intp).reshape(-1, num_words)
+
+    cost = np.sum(emission[np.arange(num_words), sequences], axis=1)
+    if order == 1:
+        cost += np.asarray(model.beginning_cost)[sequences[:, 0]]
+        for i in range(1, num_words):
+            cost += np.asarray(model.transition_1_cost)[sequences[:, i], sequences[:, i - 1]]
+        return sequences, cost
+
+    cost += np.asarray(model.tag_cost)[sequences[:, 0]]
+    if num_words > 1:
+        cost += model.transition_1_cost[sequences[:, 1], sequences[:, 0]]
+    for i in range(2, num_words):
+        cost += model.transition_2_lookup(sequences[:, i], sequences[:, i - 1], sequences[:, i - 2])
+    return sequences, cost
+
+
+"""
+Checks that second order Viterbi without pruning finds tags with the minimum posterior cost over all tag sequences,
+for every test sentence of at most 4 words, decoded one by one and all sentences of same length in one batch, with
+and without tag dictionary (which leaves few pairs of tags, so steps extend only those, see
+Complex._viterbi_sparse_step)
+"""
+
+
+def check_viterbi():
+    model, X_test = _fit(Complex)
+    model.DECODER = 'viterbi'
+    model.VITERBI_PRUNE_MARGIN = None
+    for tag_dictionary in [False, True]:
+        model.TAG_DICTIONARY = tag_dictionary
+        _check_viterbi(model, X_test)
+
+
+def _check_viterbi(model, X_test):
+    short = [sentence for sentence in X_test if len(sentence) <= 4]
+    _expect(len(short) > 0, 'No test sentences of at most 4 words')
+    batches = {}
+    for sentence in short:
+        batches.setdefault(len(sentence), []).append(sentence)
+
+    for sentences in batches.values():
+        emission = np.stack([model.emission_matrix(sentence) for sentence in sentences])
+        batched = model._viterbi(emission)
+        for sentence, sample_emission, batch_tags in zip(sentences, emission, batched):
+            sequences, cost = _all_sequences(model, sample_emission, 2)
+            tags = model._viterbi(sample_emission[np.newaxis])[0]
+            found = model._calculate_posterior(tags, sentence)
+            _expect(np.isclose(found, np.min(cost)), 'Viterbi tags of {} cost {}, minimum is {}', sentence, found,
+                    np.min(cost))
+            _expect(np.array_equal(tags, batch_tags), 'Viterbi tags of {} differ in a batch', sentence)
+            # brute force sums the same costs as the model does
+            best = np.argmin(cost)
+            _expect(np.isclose(model._calculate_posterior(sequences[best], sentence), cost[best]),
+                    'Cost of {} differs from _calculate_posterior', sentence)
+
+
+"""
+Checks that tag probabilities of HMM.predict_proba equal the ones found by summing probabilities of every tag
+sequence, for every test sentence of at most 4 words
+"""
+
+
+def check_predict_proba():
+    model, X_test = _fit(HMM)
+    short = [sentence for sentence in X_test if len(sentence) <= 4]
+    _expect(len(short) > 0, 'No test sentences of at most 4 words')
+
+    for sentence, marginals in zip(short, model.predict_proba(short)):
+        emission = model.emission_matrix(sentence)
+        sequences, cost = _all_sequences(model, emission, 1)
+        probability = np.exp(-(cost - np.min(cost)))
+        probability /= np.sum(probability)
+
+        expected = np.zeros(emission.shape)
+        for i in range(len(sentence)):
+            expected[i] = np.bincount(sequences[:, i], weights=probability, minlength=emission.shape[1])
+        error = np.max(np.abs(marginals - expected))
+        _expect(error < 1e-6, 'Tag probabilities of {} differ by {}', sentence, error)
+
+
+"""
+Starts server on a free localhost port, checks that tags sent back equal predict_batch, that invalid requests get
+error replies on the same connection, and that the stats op counts the requests
+"""
+
+
+def check_server():
+    model, X_test = _fit(HMM)
+    expected = model.predict_batch(X_test)
+
+    async def request(reader, writer, line):
+        writer.write((line + '\n').encode())
+        await writer.drain()
+        return json.loads(await reader.readline())
+
+    async def run():
+        tagging_server = await server.start_server(model, '127.0.0.1', 0, max_batch=16)
+        try:
+            port = tagging_server.sockets[0].getsockname()[1]
+            tags = await server.tag_remote(X_test, '127.0.0.1', port)
+            _expect(tags == expected, 'Tags of server differ from predict_batch')
+
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                for line, request_id in [('not json', None), ('[1, 2]', None), ('{"id": 7}', 7),
+                                         ('{"id": 8, "tokens": [1, 2]}', 8)]:
+                    response = await request(reader, writer, line)
+                    _expect(response.get('id') == request_id and 'error' in response,
+                            'Expected error reply with id {} to {}, got {}', request_id, line, response)
+
+                response = await request(reader, writer, '{"id": 9, "op": "stats"}')
+                _expect(response.get('id') == 9 and response['stats']['requests'] == len(X_test),
+                        'Expected stats of {} requests, got {}', len(X_test), response)
+                _expect(response['stats']['batches'] >= len(X_test) / 16, 'Batches larger than max_batch: {}',
+                        response)
+            finally:
+                writer.close()
+        finally:
+            tagging_server.close()
+            await tagging_server.wait_closed()
+            await tagging_server.batcher.stop()
+
+    asyncio.run(run())
+
+
+CHECKS = {'statistics': check_statistics, 'parallel': check_parallel, 'storage': check_storage,
+          'sparse': check_sparse, 'crossval': check_crossval,
+          'blanket': check_blanket, 'viterbi': check_viterbi,
+          'predict_proba': check_predict_proba, 'server': check_server}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run correctness checks of models and server')
+    parser.add_argument('checks', nargs='*', help='checks to run, one of {}, default is all'.format(', '.join(CHECKS)))
+    args = parser.parse_args()
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error('Invalid check {}. Use one of {}'.format(name, ', '.join(CHECKS)))
+
+    failed = 0
+    for name in args.checks or list(CHECKS):
+        try:
+            CHECKS[name]()
+            print('{:20s} ok'.format(name), flush=True)
+        except Exception as e:
+            failed += 1
+            print('{:20s} FAILED: {}'.format(name, e), flush=True)
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
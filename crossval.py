@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+from pos_data import read
+from metrics import Accumulator
+from models.statistics import Statistics
+from models.simple import Simple
+from models.hmm import HMM
+from models.complex import Complex
+
+
+"""
+K-fold cross-validation and hyperparameter sweeps
+
+The corpus is counted once, fold by fold. Training statistics of each fold are the counts of the whole corpus minus
+the counts of that fold, and costs for every hyperparameter setting are derived from these counts again with
+fit_statistics, so the corpus is never scanned again. Folds run in parallel worker processes.
+
+Usage:
+./crossval.py --data data/bc.val --model hmm --folds 5 --param MISSING_EMISSION_COST=10,15,20 \
+    --param MISSING_WORD_PROBABILITY=1e-4,1e-6
+
+Note that both transition costs use MISSING_WORD_PROBABILITY for unseen tag sequences.
+"""
+
+MODELS = {'simple': Simple, 'hmm': HMM, 'complex': Complex}
+
+
+"""
+Input
+num_sentences: number of sentences
+folds: number of folds
+
+Output
+list of (start, end), sentences of each fold, consecutive and of nearly same size
+"""
+
+
+def fold_ranges(num_sentences, folds):
+    bounds = [num_sentences * i // folds for i in range(folds + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+"""
+Input
+model_class: class of model, e.g. models.hmm.HMM
+X: list of sentences, where each sentence is list of strings
+y: list of tags associated with X
+grid: dict of hyperparameter name -> list of values, every combination is evaluated
+folds: number of folds
+n_jobs: number of worker processes, defaults to number of CPUs
+params: dict of hyperparameters set for every combination
+
+Output
+list of dicts with params, metrics of all folds together and word accuracy of each fold, for every combination
+in order of itertools.product of grid values
+"""
+
+
+def cross_validate(model_class, X, y, grid, folds=5, n_jobs=None, params=None):
+    if folds < 2:
+        raise Exception('Invalid number of folds {}. Use at least 2'.format(folds))
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    names = list(grid)
+    settings = [dict(params or {}, **dict(zip(names, values))) for values in product(*[grid[n] for n in names])]
+
+    # count every fold once, the whole corpus is the sum of the folds
+    ranges = fold_ranges(len(X), folds)
+    fold_statistics = []
+    total = Statistics()
+    for start, end in ranges:
+        statistics = Statistics()
+        statistics.partial_fit(X[start:end], y[start:end])
+        fold_statistics.append(statistics)
+        total.merge(statistics)
+
+    with ProcessPoolExecutor(min(n_jobs, folds), initializer=_init_worker, initargs=(total,)) as pool:
+        futures = [pool.submit(_evaluate_fold, model_class, settings, fold_statistics[i], X[start:end], y[start:end])
+                   for (i, (start, end)) in enumerate(ranges)]
+        fold_results = [future.result() for future in futures]
+
+    result = []
+    for i, setting in enumerate(settings):
+        accumulator = Accumulator()
+        for accumulators in fold_results:
+            accumulator.merge(accumulators[i])
+        metrics = accumulator.result()
+        result.append({
+            'params': setting,
+            'word_accuracy': metrics['word_accuracy'],
+            'sentence_accuracy': metrics['sentence_accuracy'],
+            'fold_word_accuracy': [accumulators[i].result()['word_accuracy'] for accumulators in fold_results],
+        })
+    return result
+
+
+# state of a worker process
+_total = None
+
+
+def _init_worker(total):
+    global _total
+    _total = total
+
+
+"""
+Fits model on all folds but one for every setting, and evaluates it on that fold
+
+Output
+list of Accumulator for each setting
+"""
+
+
+def _evaluate_fold(model_class, settings, statistics, X, y):
+    train = _total.copy()
+    train.subtract(statistics)
+
+    result = []
+    for setting in settings:
+        model = model_class()
+        vars(model).update(setting)
+        model.fit_statistics(train)
+
+        accumulator = Accumulator()
+        accumulator.update(y, model.predict_batch(X))
+        result.append(accumulator)
+    return result
+
+
+"""
+Parses NAME=v1,v2,... into (NAME, [v1, v2, ...]), values are JSON (numbers, true, null, ...) or plain strings
+"""
+
+
+def parse_param(text):
+    name, _, values = text.partition('=')
+    if not name.isupper() or not values:
+        raise argparse.ArgumentTypeError('Invalid parameter {}. Use NAME=value1,value2,...'.format(text))
+
+    def parse_value(value):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+
+    return (name, [parse_value(value) for value in values.split(',')])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross-validate a model over a grid of hyperparameters')
+    parser.add_argument('--data', default='data/bc.val', help='tagged corpus')
+    parser.add_argument('--format', default='line', choices=['line', 'column'])
+    parser.add_argument('--tag-column', type=int, default=1)
+    parser.add_argument('--model', default='hmm', choices=list(MODELS))
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes, default is CPU count')
+    parser.add_argument('--param', type=parse_param, action='append', default=[],
+                        help='NAME=value1,value2,... hyperparameter values to sweep, may be repeated')
+    parser.add_argument('--output', default=None, help='JSON file to write results to, default is stdout')
+    args = parser.parse_args()
+
+    X, y = read(args.data, 'train', args.format, args.tag_column)
+    results = cross_validate(MODELS[args.model], X, y, dict(args.param), args.folds, args.jobs)
+
+    report = {'data': args.data, 'model': args.model, 'folds': args.folds, 'sentences': len(X),
+              'best': max(results, key=lambda r: r['word_accuracy']), 'results': results}
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
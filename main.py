@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import os
+
 from pos_data import read
 from models.simple import Simple
 from models.hmm import HMM
@@ -7,8 +9,11 @@ from models.complex import Complex
 from metrics import print_report
 
 
-X_train, y_train = read('data/bc.train', 'train')
-X_val, y_val = read('data/bc.val', 'train')
+# data/train.txt has another tagset, so the first 1600 sentences of bc.val are used for training and the rest for
+# validation
+X, y = read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'bc.val'), 'train')
+X_train, y_train = X[:1600], y[:1600]
+X_val, y_val = X[1600:], y[1600:]
 
 print('Simple model')
 sm = Simple()
@@ -1,45 +1,166 @@
 #!/usr/bin/env python3
 
+import numpy as np
+
+
 """
 Prints different accuracy measures
 """
 
 
 def print_report(y_actual, y_pred):
-    sentences_total = len(y_actual)
-    words_total = sum([len(output) for output in y_actual])
+    accumulator = Accumulator()
+    accumulator.update(y_actual, y_pred)
+    format_report(accumulator.result())
+
+
+"""
+Prints results returned by Accumulator.result
+"""
+
+
+def format_report(result):
+    print('{:50s}: {:.2f}%'.format('Sentences correctly predicted', result['sentence_accuracy'] * 100))
+    print('{:50s}: {:.2f}%'.format('Words correctly predicted', result['word_accuracy'] * 100))
+    print('{:50s}: {:.2f}'.format('Average length of sentence in test set', result['average_length']))
+    print('{:50s}: {:.2f}'.format('Average length of sentence correctly predicted',
+                                  result['average_length_correct']))
+    print('{:50s}: {}'.format('Length of longest sentence correctly predicted', result['longest_correct']))
+
+
+"""
+Accumulates accuracy measures over batches of (actual, predicted) tags, so that predictions never have to be held in
+memory all at once. Tags are compared as arrays of ids, and confusion matrix is counted with bincount
+"""
+
+
+class Accumulator:
+    def __init__(self):
+        """
+        Stores numerical index for each tag seen so far, in order of first appearance
+        """
+        self.tagIndex = {}
+
+        """
+        confusion[actual tag, predicted tag] = number of words
+        """
+        self.confusion = np.zeros((0, 0), dtype=np.int64)
+
+        self.sentences_total = 0
+        self.sentences_correct = 0
+
+        """
+        Stores sum of length of all sentences predicted fully correctly
+        """
+        self.words_correct_all = 0
+
+        """
+        Stores length of longest sentence predicted fully correctly
+        """
+        self.longest_correct = 0
 
-    sentences_correct = 0
-    words_correct = 0
+    """
+    Input
+    y_actual: list (or any iterable) of actual tags of each sentence
+    y_pred: list (or any iterable) of predicted tags of each sentence, same lengths as y_actual
+    """
+
+    def update(self, y_actual, y_pred):
+        y_actual, y_pred = list(y_actual), list(y_pred)
+        if len(y_actual) != len(y_pred):
+            raise Exception('Number of actual sentences {} and predicted sentences {} do not match'.format(
+                len(y_actual), len(y_pred)))
+
+        lengths = np.array([len(ya) for ya in y_actual], dtype=np.intp)
+        for i, (ya, yp) in enumerate(zip(y_actual, y_pred)):
+            if len(ya) != len(yp):
+                raise Exception('Number of actual tags {} and predicted tags {} of sentence {} do not match'.format(
+                    len(ya), len(yp), i))
+
+        actual = self._ids(tag for ya in y_actual for tag in ya)
+        predicted = self._ids(tag for yp in y_pred for tag in yp)
+        self.update_ids(actual, predicted, lengths)
 
-    # variables to track information about sentences fully correctly predicted
     """
-    Stores sum of length of all sentences predicted fully correctly
+    Same as update, for tags already converted to ids of tagIndex
+
+    Input
+    actual, predicted: arrays of tag ids of all words of all sentences one after another
+    lengths: array of length of each sentence
     """
-    words_correct_all = 0
+
+    def update_ids(self, actual, predicted, lengths):
+        num_tags = len(self.tagIndex)
+        self.confusion += np.bincount(actual * num_tags + predicted,
+                                      minlength=num_tags * num_tags).reshape(num_tags, num_tags)
+
+        # number of wrong words in each sentence
+        offsets = np.zeros(len(lengths) + 1, dtype=np.intp)
+        np.cumsum(lengths, out=offsets[1:])
+        wrong = np.concatenate([[0], np.cumsum(actual != predicted)])
+        all_correct = (wrong[offsets[1:]] - wrong[offsets[:-1]]) == 0
+
+        self.sentences_total += len(lengths)
+        self.sentences_correct += int(np.count_nonzero(all_correct))
+        self.words_correct_all += int(np.sum(lengths[all_correct]))
+        if np.any(all_correct):
+            self.longest_correct = max(self.longest_correct, int(np.max(lengths[all_correct])))
 
     """
-    Stores length of longest sentence predicted fully correctly
+    Adds counts of other accumulator to these, e.g. of another fold or another chunk of predictions
     """
-    longest_correct = 0
 
-    for ya, yp in zip(y_actual, y_pred):
-        all_correct = True
-        for wya, wyp in zip(ya, yp):
-            if wya == wyp:
-                words_correct += 1
-            else:
-                all_correct = False
-        if all_correct:
-            sentences_correct += 1
-            words_correct_all += len(ya)
-            if len(ya) > longest_correct:
-                longest_correct = len(ya)
+    def merge(self, other):
+        ids = self._ids(other.tagIndex)
+        self.confusion[np.ix_(ids, ids)] += other.confusion
+        self.sentences_total += other.sentences_total
+        self.sentences_correct += other.sentences_correct
+        self.words_correct_all += other.words_correct_all
+        self.longest_correct = max(self.longest_correct, other.longest_correct)
 
-    print('{:50s}: {:.2f}%'.format('Sentences correctly predicted',
-                                   sentences_correct/sentences_total*100))
-    print('{:50s}: {:.2f}%'.format('Words correctly predicted', words_correct/words_total*100))
-    print('{:50s}: {:.2f}'.format('Average length of sentence in test set', words_total/sentences_total))
-    print('{:50s}: {:.2f}'.format('Average length of sentence correctly predicted',
-                                  words_correct_all/sentences_total))
-    print('{:50s}: {}'.format('Length of longest sentence correctly predicted', longest_correct))
+    """
+    Output
+    dict of accuracy measures, confusion matrix and precision, recall and f1 of each tag
+    """
+
+    def result(self):
+        words_total = int(np.sum(self.confusion))
+        words_correct = int(np.trace(self.confusion))
+        sentences_total = max(self.sentences_total, 1)
+
+        actual_count = np.sum(self.confusion, axis=1)
+        predicted_count = np.sum(self.confusion, axis=0)
+        correct_count = np.diag(self.confusion)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(predicted_count > 0, correct_count / predicted_count, 0.0)
+            recall = np.where(actual_count > 0, correct_count / actual_count, 0.0)
+            f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+        tags = list(self.tagIndex)
+        return {
+            'sentences_total': self.sentences_total,
+            'sentences_correct': self.sentences_correct,
+            'sentence_accuracy': self.sentences_correct / sentences_total,
+            'words_total': words_total,
+            'words_correct': words_correct,
+            'word_accuracy': words_correct / max(words_total, 1),
+            'average_length': words_total / sentences_total,
+            # sum of lengths of fully correct sentences divided by number of all sentences
+            'average_length_correct': self.words_correct_all / sentences_total,
+            'longest_correct': self.longest_correct,
+            'tags': tags,
+            'confusion': self.confusion.tolist(),
+            'per_tag': {tag: {'precision': float(precision[i]), 'recall': float(recall[i]), 'f1': float(f1[i]),
+                              'support': int(actual_count[i])} for (i, tag) in enumerate(tags)},
+        }
+
+    """
+    Converts tags into ids, indexing new tags and growing confusion matrix
+    """
+
+    def _ids(self, tags):
+        ids = np.fromiter((self.tagIndex.setdefault(tag, len(self.tagIndex)) for tag in tags), dtype=np.intp)
+        grow = len(self.tagIndex) - len(self.confusion)
+        if grow > 0:
+            self.confusion = np.pad(self.confusion, [(0, grow), (0, grow)])
+        return ids
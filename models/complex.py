@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import zlib
+
 import numpy as np
 
 from models.probabilistic import Probabilistic
@@ -11,7 +13,9 @@ The tag depends on word as well as previous tag, and tag previous to that
 Here we optimize P(tag_1, tag_2, ... tag_n|word_1, word_2, ... word_n)
     = P(tag_1) * P(tag_2|tag_1) * ... * P(tag_n|tag_n-1) * P(word_1|tag_1) * ... * P(word_n|tag_n)
 
-Optimization is done using Marcov Chain Monte Carlo with Gibbs sampling.
+Optimization is done using Marcov Chain Monte Carlo with Gibbs sampling, exactly using second order Viterbi
+algorithm when DECODER is 'viterbi' (approximately if VITERBI_PRUNE_MARGIN is set), or approximately using beam
+search when DECODER is 'beam'.
 """
 
 
@@ -21,75 +25,437 @@ class Complex(Probabilistic):
 
         # Hyperparameters
         self.NUM_GIBBS_ITER = 150
+        # when set, number of Gibbs iterations of a sentence is this times its number of words instead of NUM_GIBBS_ITER
+        self.GIBBS_ITER_PER_WORD = None
+        # when set, sampling of a sentence stops once its tags did not change for this many iterations
+        self.GIBBS_PATIENCE = None
+        # tags sampling starts from, 'random', or decoded like 'simple' or 'hmm' model does
+        self.GIBBS_INIT = 'random'
+        # resample every third word together instead of one random word at a time, see _gibbs
+        self.GIBBS_BLOCKED = False
+        # when set, sampling of every sentence is seeded by SEED and its words so results are reproducible
+        self.SEED = None
+        # 'gibbs', 'viterbi' or 'beam'
+        self.DECODER = 'gibbs'
+        # when set, viterbi drops pairs of tags whose cost is more than this above the best pair, which is faster but
+        # no longer exact. None keeps all pairs
+        self.VITERBI_PRUNE_MARGIN = None
+        # a step of viterbi compares number of sentences x number of tags ** 3 costs, larger buckets are split
+        self.VITERBI_MAX_CELLS = 2 ** 22
 
     """
-    Calculates all the probabilities required for the model to predict new sentences
+    Calculates tags for each sentence using Gibbs sampling or second order Viterbi, see DECODER
 
     Input
     X: list of sentences, where each sentence is list of strings
-    y: list of tags associated with X
+
+    Output
+    list of tags
     """
 
-    def fit(self, X, y):
-        self._fetch_tags(y)
-        self._calculate_tag_cost(y)
-        self._calculate_emission_cost(X, y)
-        self._calculate_transition_1_cost(y)
-        self._calculate_transition_2_cost(y)
+    def _predict(self, X):
+        if self.DECODER in ['viterbi', 'beam']:
+            return [[self.tagValue[t] for t in self._decode_batch(self.emission_matrix(sample)[np.newaxis])[0]]
+                    for sample in X]
+        if self.DECODER != 'gibbs':
+            raise Exception('Invalid decoder {}. Use \'gibbs\', \'viterbi\' or \'beam\''.format(self.DECODER))
 
-    def predict(self, X):
         result = []
         for sample in X:
-            # randomly initilize tags
-            tags = np.random.choice(np.arange(len(self.tagIndex)), len(sample))
+            emission = self.emission_matrix(sample)[np.newaxis]
+            tags = self._gibbs(emission, self._generator(emission))
+            result.append([self.tagValue[t] for t in tags[0]])
+        return result
+
+    """
+    Same as predict, for a batch of sentences of equal length
+
+    Input
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs
+
+    Output
+    (number of sentences x number of words) array of tag indexes
+    """
+
+    def _decode_batch(self, emission):
+        if self.DECODER == 'viterbi':
+            return self._viterbi(emission)
+        if self.DECODER == 'beam':
+            return np.array([self._beam_search(sample, np.asarray(self.tag_cost), self._beam_transition, 2)
+                             for sample in emission], dtype=np.intp).reshape(emission.shape[:2])
+        return self._gibbs(emission, self._generator(emission))
+
+    """
+    Gibbs sampling of a batch of sentences of equal length. Every iteration resamples one randomly chosen word
+    in each sentence of the batch, the distributions for all sentences and all tags are computed together.
+
+    When GIBBS_BLOCKED is set, every iteration is a sweep over the whole sentence instead. Words 3 or more apart do
+    not share any trigram, so given all other tags they are independent, and every third word (k mod 3 = r) is
+    resampled at once. A sweep counts as many iterations as there are words, so NUM_GIBBS_ITER and GIBBS_PATIENCE
+    mean the same number of resampled words in both modes.
+
+    A sentence stops being sampled once its tags did not change for GIBBS_PATIENCE iterations. Words that have only
+    one tag with finite emission cost (see tag_dictionary) are never sampled
+
+    Input
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs
+    rng: numpy.random.Generator
+
+    Output
+    (number of sentences x number of words) array of tag indexes
+    """
+
+    def _gibbs(self, emission, rng):
+        num_samples, num_words, num_tags = emission.shape
+        tags = self._initial_tags(emission, rng)
+        if num_words == 0:
+            return tags
+
+        # words with a single allowed tag get it and are not sampled
+        allowed = np.isfinite(emission)
+        free = np.sum(allowed, axis=2) != 1
+        tags = np.where(free, tags, np.argmax(allowed, axis=2))
+        num_free = np.sum(free, axis=1)
+
+        # number of iterations of each sentence
+        if self.GIBBS_ITER_PER_WORD is not None:
+            num_iter = np.ceil(self.GIBBS_ITER_PER_WORD * num_free).astype(np.intp)
+        else:
+            num_iter = np.full(num_samples, self.NUM_GIBBS_ITER, dtype=np.intp)
+        num_iter[num_free == 0] = 0
+
+        # words resampled together, in the order they are resampled in a sweep
+        blocks = [np.arange(r, num_words, 3) for r in range(min(3, num_words))]
+        blocks = [block[np.any(free[:, block], axis=0)] for block in blocks]
+        blocks = [block for block in blocks if len(block) > 0]
+
+        # number of iterations each sentence was sampled, and since its tags last changed
+        iterations = np.zeros(num_samples, dtype=np.intp)
+        unchanged = np.zeros(num_samples, dtype=np.intp)
+        active = num_iter > 0
 
-            for iter in range(self.NUM_GIBBS_ITER):
-                # Choose a word at random for which we will find best tag
-                word_idx = np.random.randint(0, len(sample))
+        with self._timer('gibbs.sample'):
+            if self.GIBBS_BLOCKED:
+                # a sweep counts as many iterations as there are words, whether they are free or not
+                step_iter = num_words
+                num_steps = int(np.ceil(np.max(num_iter) / num_words))
+            else:
+                step_iter = 1
+                num_steps = int(np.max(num_iter))
+                # free words of each sentence first
+                free_order = np.argsort(~free, axis=1, kind='stable')
 
-                prob_dist = self._calculate_probability_dist(tags, sample, word_idx)
+            for step in range(num_steps):
+                if self.GIBBS_BLOCKED:
+                    changed = np.zeros(num_samples, dtype=bool)
+                    for block in blocks:
+                        word_idx = np.broadcast_to(block, (num_samples, len(block)))
+                        changed |= self._gibbs_step(tags, emission, word_idx, active, rng)
+                else:
+                    # Choose a word at random in each sentence for which we will find best tag
+                    if np.all(free):
+                        word_idx = rng.integers(0, num_words, num_samples)
+                    else:
+                        word_idx = free_order[np.arange(num_samples), rng.integers(0, np.maximum(num_free, 1))]
+                    changed = self._gibbs_step(tags, emission, word_idx, active, rng)
 
-                # Select randomly over given new probability distribution
-                tag_idx = np.random.choice(np.arange(len(prob_dist)), p=prob_dist)
-                tags[word_idx] = tag_idx
+                iterations += active * step_iter
+                unchanged = np.where(changed, 0, unchanged + step_iter)
+                active &= iterations < num_iter
+                if not np.any(active):
+                    break
+                if self.GIBBS_PATIENCE is not None:
+                    active &= unchanged < self.GIBBS_PATIENCE
+                    if not np.any(active):
+                        break
 
-            # sampling may randomly (with very low probability) pick very unlikely tag for a particular word, therefore
-            # return most likely tag for each word using generated posterior probabilities
+        # sampling may randomly (with very low probability) pick very unlikely tag for a particular word, therefore
+        # return most likely tag for each word using generated posterior probabilities
+        with self._timer('gibbs.greedy'):
+            if not self.GIBBS_BLOCKED:
+                blocks = [np.array([idx]) for idx in np.flatnonzero(np.any(free, axis=0))]
             for iter in range(5):
-                for idx in range(len(tags)):
-                    tags[idx] = np.argmax(self._calculate_probability_dist(tags, sample, idx))
+                previous = tags.copy()
+                for block in blocks:
+                    word_idx = np.broadcast_to(block, (num_samples, len(block)))
+                    tags[:, block] = np.argmin(self._markov_blanket_cost(tags, emission, word_idx), axis=-1)
+                # further sweeps would not change anything either
+                if np.array_equal(tags, previous):
+                    break
 
-            result.append([self.tagValue[t] for t in tags])
-        return result
+        self._count('gibbs_sentences', num_samples)
+        self._count('gibbs_iterations', int(np.sum(iterations)))
+        self._count('gibbs_converged', int(np.count_nonzero(iterations < num_iter)))
+        self._count('gibbs_fixed_words', int(np.count_nonzero(~free)))
+        return tags
 
     """
-    Calculates probability distribution over each tag assigned to word at index i, keeping all other tags same.
-    Returns an array of "probabilities" for each tag as per indexes specified in self.tagIndex
+    Resamples tags of words word_idx of every active sentence, in place
+
+    Input
+    tags: (number of sentences x number of words) array of current tag indexes
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs
+    word_idx: index of the word in each sentence, or (number of sentences x number of words resampled) indexes of
+              words that do not share any trigram
+    active: boolean array, sentences that are resampled
+    rng: numpy.random.Generator
+
+    Output
+    boolean array, sentences whose tags changed
+    """
+
+    def _gibbs_step(self, tags, emission, word_idx, active, rng):
+        num_tags = emission.shape[2]
+        rows = np.arange(len(tags)).reshape((-1,) + (1,) * (word_idx.ndim - 1))
+        old_tags = tags[rows, word_idx]
+
+        prob_dist = self._calculate_probability_dist(tags, emission, word_idx)
+
+        # Select randomly over given new probability distribution, by inverting the cumulative distribution
+        cumulative = np.cumsum(prob_dist, axis=-1)
+        draw = rng.random(cumulative.shape[:-1] + (1,)) * cumulative[..., -1:]
+        new_tags = np.minimum(np.sum(cumulative <= draw, axis=-1), num_tags - 1)
+
+        # sentences that already converged keep their tags
+        new_tags = np.where(active.reshape(rows.shape), new_tags, old_tags)
+        tags[rows, word_idx] = new_tags
+        return np.any((new_tags != old_tags).reshape(len(tags), -1), axis=1)
+
+    """
+    Tags Gibbs sampling starts from, see GIBBS_INIT
+
+    Input
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs
+    rng: numpy.random.Generator, used for random tags
+
+    Output
+    (number of sentences x number of words) array of tag indexes
+    """
+
+    def _initial_tags(self, emission, rng):
+        num_samples, num_words, num_tags = emission.shape
+        if self.GIBBS_INIT == 'random':
+            allowed = np.isfinite(emission)
+            if np.all(allowed):
+                return rng.choice(np.arange(num_tags), (num_samples, num_words))
+            # uniformly among tags allowed by tag dictionary
+            return np.argmax(rng.random(emission.shape) * allowed, axis=2)
+        if self.GIBBS_INIT == 'simple':
+            return np.argmin(emission + np.asarray(self.tag_cost), axis=2)
+        if self.GIBBS_INIT == 'hmm':
+            return self._first_order_viterbi(emission, self.beginning_cost)
+        raise Exception('Invalid Gibbs initialization {}. Use \'random\', \'simple\' or \'hmm\''.format(
+            self.GIBBS_INIT))
+
+    """
+    Second order Viterbi decoding, finds tags with minimum cost as defined by _calculate_posterior
+
+    The states are pairs of tags (previous tag, current tag), cost[s, a, b] is the minimum cost of first words of
+    sentence s ending with tags a, b. Each step minimizes over the tag before previous for all pairs at once.
+    If VITERBI_PRUNE_MARGIN is set, pairs that are more than that worse than the best pair of the sentence are
+    dropped, which keeps it fast for larger tagsets but makes the search approximate. When few pairs remain (after
+    pruning, or because of tag_dictionary), a step only extends the remaining pairs of each sentence, see
+    _viterbi_sparse_step, otherwise it considers every pair of tags that remain in some sentence
+
+    Input
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs
+
+    Output
+    (number of sentences x number of words) array of tag indexes
     """
 
-    def _calculate_probability_dist(self, tags, sentence, word_idx):
-        distribution = np.zeros(len(self.tagIndex))
-        original_tag = tags[word_idx]
+    def _viterbi(self, emission):
+        num_samples, num_words, num_tags = emission.shape
+        batch_size = max(1, self.VITERBI_MAX_CELLS // num_tags ** 3)
+        if num_samples > batch_size:
+            return np.concatenate([self._viterbi(emission[start:start + batch_size])
+                                   for start in range(0, num_samples, batch_size)])
+
+        tag_cost = np.asarray(self.tag_cost)
+        samples = np.arange(num_samples)
+        tags = np.zeros((num_samples, num_words), dtype=np.intp)
+
+        if num_words == 0:
+            return tags
+        if num_words == 1:
+            tags[:, 0] = np.argmin(tag_cost + emission[:, 0], axis=1)
+            return tags
+
+        # cost[s, a, b] for first 2 words
+        cost = ((tag_cost + emission[:, 0])[:, :, np.newaxis] + self.transition_1_cost.T
+                + emission[:, 1, np.newaxis, :])
+
+        # tags with finite emission cost in some sentence for every word, see tag_dictionary
+        if self.tag_dictionary is not None:
+            allowed = [np.flatnonzero(a) for a in np.any(np.isfinite(emission), axis=0)]
+        else:
+            allowed = [np.arange(num_tags)] * num_words
+
+        # backpointer[wi][s, b, c] is the best tag of word wi - 2, given tags b, c of words wi - 1, wi
+        with self._timer('viterbi.fill'):
+            backpointer = np.zeros((num_words, num_samples, num_tags, num_tags), dtype=np.min_scalar_type(num_tags))
+            for wi in range(2, num_words):
+                if self.VITERBI_PRUNE_MARGIN is not None:
+                    best = np.min(cost, axis=(1, 2), keepdims=True)
+                    cost[cost > best + self.VITERBI_PRUNE_MARGIN] = np.inf
+                alive = np.isfinite(cost)
+                prev_2 = np.flatnonzero(np.any(alive, axis=(0, 2)))
+                prev_1 = np.flatnonzero(np.any(alive, axis=(0, 1)))
+                cur = allowed[wi]
 
-        for tag_idx in range(len(self.tagIndex)):
-            tags[word_idx] = tag_idx
+                # most pairs of the tags that remain in some sentence are not left in any sentence
+                if 2 * np.count_nonzero(alive) < num_samples * len(prev_2) * len(prev_1):
+                    cost = self._viterbi_sparse_step(cost, alive, emission[:, wi], cur, backpointer[wi])
+                    continue
 
-            # store the value at index corresponding to that tag
-            distribution[tag_idx] = self._calculate_posterior(tags, sentence)
+                # candidates[s, c, b, a] = cost[s, a, b] + transition_2_cost[c, b, a]
+                candidates = (cost[:, prev_2][:, :, prev_1].transpose(0, 2, 1)[:, np.newaxis]
+                              + self.transition_2_lookup(cur[:, np.newaxis, np.newaxis], prev_1[:, np.newaxis], prev_2))
+                best_prev_2 = np.argmin(candidates, axis=3)
 
-        tags[word_idx] = original_tag
+                cost = np.full((num_samples, num_tags, num_tags), np.inf)
+                cost[:, prev_1[:, np.newaxis], cur] = (
+                    np.take_along_axis(candidates, best_prev_2[..., np.newaxis], axis=3)[..., 0]
+                    + emission[:, wi, cur, np.newaxis]).transpose(0, 2, 1)
+                backpointer[wi][:, prev_1[:, np.newaxis], cur] = prev_2[best_prev_2].transpose(0, 2, 1)
+
+        # backtrack from best pair of last 2 tags
+        with self._timer('viterbi.backtrack'):
+            last = np.argmin(cost.reshape(num_samples, -1), axis=1)
+            tags[:, -2], tags[:, -1] = np.divmod(last, num_tags)
+            for wi in range(num_words - 1, 1, -1):
+                tags[:, wi - 2] = backpointer[wi][samples, tags[:, wi - 1], tags[:, wi]]
+        return tags
+
+    """
+    Step of _viterbi that only extends pairs of tags that remain in each sentence. Remaining pairs (a, b) of all
+    sentences are listed sorted by sentence and tag b, so the best tag a for every sentence, b and next tag c is the
+    minimum over a group of consecutive rows
+
+    Input
+    cost: (number of sentences x number of tags x number of tags) costs of pairs of tags ending at previous word
+    alive: cost is finite
+    emission: (number of sentences x number of tags) emission costs of the word
+    cur: tags the word may have
+    backpointer: (number of sentences x number of tags x number of tags) array to store best tags a in
+
+    Output
+    costs of pairs of tags ending at the word
+    """
+
+    def _viterbi_sparse_step(self, cost, alive, emission, cur, backpointer):
+        sample, tag_b, tag_a = np.nonzero(alive.transpose(0, 2, 1))
+
+        # candidates[k, c] = cost of pair k followed by tag cur[c]
+        candidates = (cost[sample, tag_a, tag_b][:, np.newaxis]
+                      + self.transition_2_lookup(cur, tag_b[:, np.newaxis], tag_a[:, np.newaxis]))
+
+        starts = np.flatnonzero(np.concatenate([[True], (sample[1:] != sample[:-1]) | (tag_b[1:] != tag_b[:-1])]))
+        best = np.minimum.reduceat(candidates, starts, axis=0)
+        # first row of each group with the best cost, i.e. the lowest tag a like argmin
+        rows = np.arange(len(sample))[:, np.newaxis]
+        is_best = candidates == np.repeat(best, np.diff(np.append(starts, len(sample))), axis=0)
+        best_row = np.minimum.reduceat(np.where(is_best, rows, len(sample)), starts, axis=0)
+
+        group_sample, group_b = sample[starts, np.newaxis], tag_b[starts, np.newaxis]
+        cost = np.full(cost.shape, np.inf)
+        cost[group_sample, group_b, cur] = best + emission[group_sample, cur]
+        backpointer[group_sample, group_b, cur] = tag_a[best_row]
+        return cost
+
+    def _cost_names(self):
+        names = ['tag_cost', 'transition_1_cost', 'transition_2_cost', 'emission_cost', 'tag_dictionary']
+        # initial tags decoded like hmm model does need its beginning cost
+        if self.GIBBS_INIT == 'hmm':
+            names.append('beginning_cost')
+        return names
+
+    def _beam_transition(self, wi, prev_2, prev_1):
+        if wi == 1:
+            return self.transition_1_cost[:, prev_1].T
+        return self.transition_2_lookup(np.arange(len(self.tagIndex)), prev_1[:, np.newaxis], prev_2[:, np.newaxis])
+
+    """
+    Input
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs of sentences
+              sampled together
+
+    Output
+    random number generator seeded by SEED and emission costs of the first sentence, which only depend on its words,
+    or seeded randomly if SEED is not set
+    """
+
+    def _generator(self, emission):
+        if self.SEED is None:
+            return np.random.default_rng()
+        return np.random.default_rng((self.SEED, zlib.crc32(np.ascontiguousarray(emission[0]).tobytes())))
+
+    """
+    Calculates probability distribution over each tag assigned to word at index word_idx, keeping all other tags same.
+    Returns an array of "probabilities" for each tag as per indexes specified in self.tagIndex
+
+    Input
+    tags: (number of sentences x number of words) array of current tag indexes
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs
+    word_idx: index of the word to find distribution for, in each sentence, or (number of sentences x m) indexes
+
+    Output
+    (number of sentences x number of tags) array of probabilities, or (number of sentences x m x number of tags)
+    """
+
+    def _calculate_probability_dist(self, tags, emission, word_idx):
+        distribution = self._markov_blanket_cost(tags, emission, word_idx)
 
         # Convert likelyhood into probability distribution to make sampling easier
         # subtracting minimum is same as dividing probabilities, which keeps the relative probabilities the same
         # 10 times more likely event will still be 10 times more likely
-        distribution -= np.min(distribution)
+        distribution -= np.min(distribution, axis=-1, keepdims=True)
 
         # convert logs into probabilities, since now they are within reasonable bounds
         distribution = np.exp(-distribution)
-        distribution /= sum(distribution)
+        distribution /= np.sum(distribution, axis=-1, keepdims=True)
 
         return distribution
 
+    """
+    Calculates the part of the posterior (see _calculate_posterior) that changes when tag of word at index word_idx
+    changes, for every possible tag of that word. All other terms are same for every tag, so they do not affect
+    the distribution of that tag. These are the terms in the Markov blanket of the word: its emission, tag cost if it
+    is the first word, and all the transitions that involve its tag, i.e. the ones to the 2 previous and 2 next tags
+
+    Input
+    tags: (number of sentences x number of words) array of current tag indexes
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs
+    word_idx: index of the word in each sentence, or (number of sentences x m) indexes of several words
+
+    Output
+    (number of sentences x number of tags) array of -log of likelyhoods, up to a constant for each sentence,
+    or (number of sentences x m x number of tags) for several words
+    """
+
+    def _markov_blanket_cost(self, tags, emission, word_idx):
+        num_samples, num_words, num_tags = emission.shape
+        samples = np.arange(num_samples).reshape((-1,) + (1,) * (np.ndim(word_idx) - 1))
+        candidates = np.arange(num_tags)
+
+        # tag of the word at offset from word_idx, as a column so it broadcasts against candidates
+        def tag_at(offset):
+            return tags[samples, np.clip(word_idx + offset, 0, num_words - 1)][..., np.newaxis]
+
+        k = word_idx[..., np.newaxis]
+        cost = emission[samples, word_idx].astype(np.float64)
+
+        cost += np.where(k == 0, np.asarray(self.tag_cost)[candidates], 0)
+        cost += np.where((k == 0) & (num_words > 1), self.transition_1_cost[tag_at(1), candidates], 0)
+        cost += np.where(k == 1, self.transition_1_cost[candidates, tag_at(-1)], 0)
+
+        # trigrams where this word is the last, the middle and the first tag
+        cost += np.where(k >= 2, self.transition_2_lookup(candidates, tag_at(-1), tag_at(-2)), 0)
+        cost += np.where((k >= 1) & (k + 1 < num_words), self.transition_2_lookup(tag_at(1), candidates, tag_at(-1)), 0)
+        cost += np.where(k + 2 < num_words, self.transition_2_lookup(tag_at(2), tag_at(1), candidates), 0)
+
+        return cost
+
     """
     Calculates likelyhood of tags (S1, S2, S3, S4...) for sentence (W1, W2, W3, W4...) using bayes theorem
     likelyhood = P(S1) * P(S2|S1) * P(S3|S2,S1) * P(S4|S3,S2) * ...
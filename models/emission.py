@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+"""
+Array backed storage of emission costs -log(P(word|tag)), indexed by word id (see Probabilistic.vocabulary) and tag index
+
+Word id equal to number of words in vocabulary stands for any unknown word, every lookup of it (and of any
+(word, tag) pair that was never observed) returns the missing cost
+"""
+
+
+class DenseEmissionTable:
+    """
+    Input
+    word_ids, tag_ids, costs: arrays describing every observed (word, tag) pair and its cost
+    num_words: size of vocabulary
+    num_tags: number of tags
+    missing_cost: cost of (word, tag) pairs not observed
+    """
+
+    def __init__(self, word_ids, tag_ids, costs, num_words, num_tags, missing_cost):
+        self.num_words = num_words
+        self.num_tags = num_tags
+        self.missing_cost = missing_cost
+
+        # extra last row for unknown words
+        self.table = np.full((num_words + 1, num_tags), missing_cost, dtype=np.float32)
+        self.table[word_ids, tag_ids] = costs
+
+    def get(self, word_id, tag):
+        return float(self.table[word_id, tag])
+
+    """
+    Input
+    word_ids: array of word ids
+
+    Output
+    (len(word_ids) x number of tags) matrix of emission costs
+    """
+
+    def rows(self, word_ids):
+        return self.table[word_ids]
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+
+class SparseEmissionTable:
+    """
+    Compressed sparse row layout: costs of word i are data[indptr[i]:indptr[i + 1]] for tags in
+    indices[indptr[i]:indptr[i + 1]], tags are sorted within each row
+
+    Input
+    same as DenseEmissionTable
+    """
+
+    def __init__(self, word_ids, tag_ids, costs, num_words, num_tags, missing_cost):
+        self.num_words = num_words
+        self.num_tags = num_tags
+        self.missing_cost = missing_cost
+
+        order = np.lexsort((tag_ids, word_ids))
+        self.indices = np.asarray(tag_ids, dtype=np.int32)[order]
+        self.data = np.asarray(costs, dtype=np.float32)[order]
+
+        # extra last row for unknown words, which is always empty
+        self.indptr = np.zeros(num_words + 2, dtype=np.int64)
+        np.cumsum(np.bincount(word_ids, minlength=num_words + 1), out=self.indptr[1:])
+
+    def get(self, word_id, tag):
+        start, end = self.indptr[word_id], self.indptr[word_id + 1]
+        pos = start + np.searchsorted(self.indices[start:end], tag)
+        if pos < end and self.indices[pos] == tag:
+            return float(self.data[pos])
+        return float(np.float32(self.missing_cost))
+
+    def rows(self, word_ids):
+        word_ids = np.asarray(word_ids)
+        result = np.full((len(word_ids), self.num_tags), self.missing_cost, dtype=np.float32)
+
+        # expand every requested row into positions of its stored entries
+        starts = self.indptr[word_ids]
+        lengths = self.indptr[word_ids + 1] - starts
+        row = np.repeat(np.arange(len(word_ids)), lengths)
+        pos = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(np.sum(lengths))
+        result[row, self.indices[pos]] = self.data[pos]
+        return result
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+
+"""
+Chooses dense table when number of cells is at most max_dense_cells, sparse table otherwise
+"""
+
+
+def build_emission_table(word_ids, tag_ids, costs, num_words, num_tags, missing_cost, max_dense_cells):
+    if (num_words + 1) * num_tags <= max_dense_cells:
+        return DenseEmissionTable(word_ids, tag_ids, costs, num_words, num_tags, missing_cost)
+    return SparseEmissionTable(word_ids, tag_ids, costs, num_words, num_tags, missing_cost)
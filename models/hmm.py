@@ -10,6 +10,9 @@ The tag depends on word as well as previous tag
 
 Optimizes P(tag_1, tag_2, ... tag_n|word_1, word_2, ... word_n)
     = P(tag_1) * P(tag_2|tag_1) * ... * P(tag_n|tag_n-1) * P(word_1|tag_1) * ... * P(word_n|tag_n)
+
+Optimization is done exactly using Viterbi algorithm, or approximately using beam search when DECODER is 'beam'.
+Posterior probability of each tag of each word is calculated exactly using forward-backward algorithm, see predict_proba
 """
 
 
@@ -17,20 +20,9 @@ class HMM(Probabilistic):
     def __init__(self):
         Probabilistic.__init__(self)
 
-    """
-    Calculates all the probabilities required for the model to predict new sentences
-
-    Input
-    X: list of sentences, where each sentence is list of strings
-    y: list of tags associated with X
-    """
-
-    def fit(self, X, y):
-        self._fetch_tags(y)
-        self._calculate_tag_cost(y)
-        self._calculate_emission_cost(X, y)
-        self._calculate_transition_1_cost(y)
-        self._calculate_beginning_cost(y)
+        # Hyperparameters
+        # 'viterbi' or 'beam'
+        self.DECODER = 'viterbi'
 
     """
     Calculates maximum a posteriori (MAP) tags for given sentence using Viterbi algorithm
@@ -45,31 +37,99 @@ class HMM(Probabilistic):
     list of tags with minimum cost, i.e. maximum posterior probability
     """
 
-    def predict(self, X):
+    def _predict(self, X):
         result = []
         for sample in X:
-            cost = np.full((len(sample), len(self.tagIndex)), np.inf)
-            cost[0, :] = self.beginning_cost
-            cost[0, :] += [self.get_emission_cost(idx, sample[0])
-                           for idx in range(len(self.tagIndex))]
-
-            # fill the dp table
-            for wi in range(1, len(sample)):
-                for ti in range(len(self.tagIndex)):
-                    for pti in range(len(self.tagIndex)):
-                        cost[wi, ti] = min(
-                            cost[wi, ti], cost[wi - 1, pti] + self.get_transition_1_cost(ti, pti) + self.get_emission_cost(ti, sample[wi]))
-
-            # backtrack to get tags that result in minimum cost
-            tags = [-1 for _ in range(len(sample))]
-            tags[-1] = np.argmin(cost[-1, :])
-            for wi in range(len(sample) - 1, 0, -1):
-                # find which previous tag lies on shortest path
-                for pti in range(len(self.tagIndex)):
-                    if cost[wi - 1, pti] + self.get_transition_1_cost(tags[wi], pti) + self.get_emission_cost(tags[wi], sample[wi]) == cost[wi, tags[wi]]:
-                        tags[wi - 1] = pti
-                        break
+            tags = self._decode_batch(self.emission_matrix(sample)[np.newaxis])[0]
 
             # return list of tags associated with indexes
             result.append([self.tagValue[t] for t in tags])
         return result
+
+    def _decode_batch(self, emission):
+        if self.DECODER == 'viterbi':
+            return self._first_order_viterbi(emission, self.beginning_cost)
+        if self.DECODER == 'beam':
+            return np.array([self._beam_search(sample, self.beginning_cost, self._beam_transition, 1)
+                             for sample in emission], dtype=np.intp).reshape(emission.shape[:2])
+        raise Exception('Invalid decoder {}. Use \'viterbi\' or \'beam\''.format(self.DECODER))
+
+    def _cost_names(self):
+        return ['beginning_cost', 'transition_1_cost', 'emission_cost', 'tag_dictionary']
+
+    def _beam_transition(self, wi, prev_2, prev_1):
+        return self.transition_1_cost[:, prev_1].T
+
+    """
+    Calculates posterior probability P(tag_i = t|word_1, ... word_n) of every tag of every word, e.g. to find words
+    the model is not sure about. Sentences are grouped by length and every group is computed together
+
+    Input
+    X: list of sentences, where each sentence is list of strings
+    batch_size: maximum number of sentences computed together
+
+    Output
+    list of (number of words x number of tags) arrays for each sentence, column t is the tag tagValue[t],
+    every row sums to 1
+    """
+
+    def predict_proba(self, X, batch_size=256):
+        result = [None for _ in range(len(X))]
+        with self._timer('predict_proba'):
+            for indexes in self._length_buckets(X, batch_size):
+                emission = np.stack([self.emission_matrix(X[i]) for i in indexes])
+                for i, marginals in zip(indexes, self._forward_backward(emission)):
+                    result[i] = marginals
+        return result
+
+    """
+    Forward-backward algorithm in log space over a batch of sentences of equal length
+
+    alpha[s, wi, t] is log of probability of first wi + 1 words of sentence s with word wi tagged t, and
+    beta[s, wi, t] is log of probability of the remaining words given word wi is tagged t. Every step sums over the
+    previous (or next) tag with logsumexp of the whole (sentences x tags x tags) tensor at once
+
+    Input
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs
+
+    Output
+    (number of sentences x number of words x number of tags) tensor of posterior probabilities of tags
+    """
+
+    def _forward_backward(self, emission):
+        num_samples, num_words, num_tags = emission.shape
+        # log probabilities, transition[t, p] = log(P(t|p))
+        log_emission = -emission.astype(np.float64)
+        transition = -np.asarray(self.transition_1_cost, dtype=np.float64)
+
+        alpha = np.empty(emission.shape)
+        beta = np.zeros(emission.shape)
+        if num_words == 0:
+            return alpha
+
+        with self._timer('forward_backward.forward'):
+            alpha[:, 0] = -np.asarray(self.beginning_cost, dtype=np.float64) + log_emission[:, 0]
+            for wi in range(1, num_words):
+                alpha[:, wi] = _logsumexp(alpha[:, wi - 1, np.newaxis, :] + transition, axis=2) + log_emission[:, wi]
+
+        with self._timer('forward_backward.backward'):
+            for wi in range(num_words - 2, -1, -1):
+                beta[:, wi] = _logsumexp((beta[:, wi + 1] + log_emission[:, wi + 1])[:, :, np.newaxis] + transition,
+                                         axis=1)
+
+        posterior = alpha + beta
+        posterior -= _logsumexp(posterior, axis=2)[:, :, np.newaxis]
+        return np.exp(posterior)
+
+
+"""
+log(sum(exp(a))) along axis, without overflow
+"""
+
+
+def _logsumexp(a, axis):
+    largest = np.max(a, axis=axis, keepdims=True)
+    # rows of all -inf (e.g. impossible tags) stay -inf instead of becoming nan
+    largest[~np.isfinite(largest)] = 0
+    with np.errstate(divide='ignore'):
+        return np.log(np.sum(np.exp(a - largest), axis=axis)) + np.squeeze(largest, axis=axis)
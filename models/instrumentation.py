@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import time
+
+
+"""
+Timers and counters of stages of fit and predict, see Probabilistic.enable_instrumentation
+
+Timers accumulate seconds and number of calls for each stage, e.g. 'emission' or 'viterbi.fill'.
+Counters accumulate numbers, e.g. 'tokens', 'unknown_tokens' or 'gibbs_iterations'.
+"""
+
+
+class Instrumentation:
+    """
+    Input
+    callback: optional function(stage, seconds) called every time a timed stage finishes
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        self.seconds.clear()
+        self.calls.clear()
+        self.counters.clear()
+
+    """
+    Output
+    dict with seconds and calls of every stage, all counters, and unknown word rate if tokens were counted
+    """
+
+    def snapshot(self):
+        result = {
+            'seconds': dict(self.seconds),
+            'calls': dict(self.calls),
+            'counters': dict(self.counters),
+        }
+        if self.counters.get('tokens', 0) > 0:
+            result['unknown_rate'] = self.counters.get('unknown_tokens', 0) / self.counters['tokens']
+        return result
+
+    def _record(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+        if self.callback is not None:
+            self.callback(stage, seconds)
+
+
+class _Timer:
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation._record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+"""
+Shared timer that does nothing, used when instrumentation is disabled
+"""
+NULL_TIMER = _NullTimer()
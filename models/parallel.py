@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from models.storage import COST_ARRAYS
+
+
+"""
+Parallel prediction over a pool of processes
+
+Every numpy array of a fitted model (cost tables, emission table, ...) is copied once into a shared memory block.
+Workers rebuild the model on startup with arrays that are views of those blocks, so the tables are neither pickled
+with every task nor duplicated in every worker.
+"""
+
+
+class SharedArray:
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+class SharedObject:
+    def __init__(self, cls, state):
+        self.cls = cls
+        self.state = state
+
+
+"""
+Replaces every numpy array reachable from value by a SharedArray placeholder, copying array into new shared memory
+
+Input
+value: object to publish, descends into dicts, lists, tuples and objects of classes from models package
+blocks: list that collects created shared memory blocks, caller has to close and unlink them
+
+Output
+picklable description of value, see attach
+"""
+
+
+def publish(value, blocks):
+    if isinstance(value, np.ndarray) and value.nbytes > 0:
+        block = shared_memory.SharedMemory(create=True, size=value.nbytes)
+        blocks.append(block)
+        np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)[...] = value
+        return SharedArray(block.name, value.shape, value.dtype)
+    if isinstance(value, dict):
+        return {k: publish(v, blocks) for (k, v) in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(publish(v, blocks) for v in value)
+    if type(value).__module__.startswith('models.') and hasattr(value, '__dict__'):
+        return SharedObject(type(value), publish(value.__dict__, blocks))
+    return value
+
+
+"""
+Opposite of publish
+
+Input
+value: description created by publish
+blocks: list that collects attached shared memory blocks, they have to stay open as long as the arrays are used
+
+Output
+copy of published object, with arrays backed by shared memory
+"""
+
+
+def attach(value, blocks):
+    if isinstance(value, SharedArray):
+        # workers share resource tracker of the publishing process, which unlinks the block when done
+        block = shared_memory.SharedMemory(name=value.name)
+        blocks.append(block)
+        return np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)
+    if isinstance(value, dict):
+        return {k: attach(v, blocks) for (k, v) in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(attach(v, blocks) for v in value)
+    if isinstance(value, SharedObject):
+        obj = value.cls.__new__(value.cls)
+        obj.__dict__.update(attach(value.state, blocks))
+        return obj
+    return value
+
+
+# state of a worker process
+_model = None
+_blocks = []
+
+
+def _init_worker(description):
+    global _model
+    _model = attach(description, _blocks)
+
+
+def _predict_chunk(X):
+    return _model._predict(X)
+
+
+"""
+See Probabilistic.predict_parallel
+"""
+
+
+def predict(model, X, n_jobs, chunk_size):
+    result = []
+    for tags in imap(model, (X[start:start + chunk_size] for start in range(0, len(X), chunk_size)), n_jobs):
+        result.extend(tags)
+    return result
+
+
+"""
+Tags a stream of chunks in parallel, keeping at most 2 chunks per worker in flight, so that memory use does not
+depend on length of the stream
+
+Input
+model: fitted model
+chunks: iterable of lists of sentences, consumed lazily
+n_jobs: number of worker processes, defaults to number of CPUs
+
+Output
+generator of list of tags of each chunk, in the same order as chunks
+"""
+
+
+def imap(model, chunks, n_jobs=None):
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    # derive costs the model uses once here, workers do not need the raw counts nor the costs it does not use
+    names = model._cost_names()
+    for name in names:
+        getattr(model, name)
+    costs = {name: cost for (name, cost) in model._costs.items() if name in names or name not in COST_ARRAYS}
+    state = dict(vars(model), _costs=costs, statistics=None, sentence_cache=None, word_cache=None,
+                 instrumentation=None)
+
+    blocks = []
+    try:
+        description = SharedObject(type(model), publish(state, blocks))
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(description,)) as pool:
+            pending = deque()
+            for X in chunks:
+                pending.append(pool.submit(_predict_chunk, X))
+                if len(pending) >= 2 * n_jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
@@ -1,21 +1,108 @@
 #!/usr/bin/env python3
 
-import math
 import numpy as np
 
+from models import parallel, storage
+from models.cache import LRUCache
+from models.instrumentation import NULL_TIMER, Instrumentation
+from models.emission import build_emission_table
+from models.statistics import Statistics, count_parallel
+from models.transition import SparseTrigramTable
+
+
+"""
+Property for a cost that is derived from statistics with _calculate_<name> when it is first needed after fitting.
+A derived value of None (e.g. tag_dictionary when it is turned off) is kept too, it is not derived again until a
+hyperparameter changes, see Probabilistic.__setattr__
+"""
+
+
+def _derived_cost(name):
+    def getter(self):
+        if name not in self._costs and self.statistics is not None:
+            with self._timer('fit.' + name):
+                self._costs[name] = getattr(self, '_calculate_' + name)()
+        return self._costs.get(name)
+
+    def setter(self, value):
+        self._costs[name] = value
+
+    return property(getter, setter)
+
 
 class Probabilistic:
+    tag_cost = _derived_cost('tag_cost')
+    emission_cost = _derived_cost('emission_cost')
+    transition_1_cost = _derived_cost('transition_1_cost')
+    transition_2_cost = _derived_cost('transition_2_cost')
+    beginning_cost = _derived_cost('beginning_cost')
+    tag_dictionary = _derived_cost('tag_dictionary')
+
     # methods to override
 
-    def fit(self, X, y):
-        pass
+    """
+    Predicts tags for sentences X. Models that sample seed every sentence by its words, so results do not depend on
+    how input is split into chunks, nor on which sentences are answered from sentence cache
 
-    def predict(self, X):
+    Input
+    X: list of sentences, where each sentence is list of strings
+
+    Output
+    list of tags for each sentence
+    """
+
+    def _predict(self, X):
         pass
 
+    """
+    Decodes a batch of sentences of the same length at once
+
+    Input
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs
+
+    Output
+    (number of sentences x number of words) array of tag indexes
+    """
+
+    def _decode_batch(self, emission):
+        raise NotImplementedError('{} does not support batched decoding'.format(type(self).__name__))
+
+    """
+    Output
+    names of costs the model decodes with, only these are derived before saving or predicting in parallel, and only
+    these are saved and published to worker processes
+    """
+
+    def _cost_names(self):
+        return ['tag_cost', 'beginning_cost', 'transition_1_cost', 'transition_2_cost', 'emission_cost',
+                'tag_dictionary']
+
     # end of methods to override
 
     def __init__(self):
+        # costs derived from statistics, see _derived_cost
+        self._costs = {}
+
+        """
+        Raw counts of training data, see models/statistics.py. Costs below are derived from them when needed
+        """
+        self.statistics = None
+
+        """
+        Optional LRU caches, see enable_cache
+        sentence_cache: tuple of words of sentence -> tuple of predicted tags
+        word_cache: word -> row of emission matrix of that word
+        Predictions depend on hyperparameters (e.g. DECODER or SEED), sentence cache is cleared when they change
+        """
+        self.sentence_cache = None
+        self.word_cache = None
+        self._cache_params = None
+
+        """
+        Optional timers and counters of stages of fit and predict, see enable_instrumentation
+        """
+        self.instrumentation = None
+
         """
         Stores numerical index for each tag
         e.g. "noun": 0, "adj": 1, ...
@@ -33,16 +120,19 @@ class Probabilistic:
         """
         self.tag_cost = None
 
+        """
+        Stores numerical id for each word seen while fitting
+        e.g. "the": 0, "dog": 1, ...
+        Any word not in vocabulary gets id len(vocabulary)
+        """
+        self.vocabulary = None
+
         """
         Emission cost is the negative log of probability of having some observed variable given some value of hidden variable.
         In this case, it would be probability of certain word given certain pos tag, P(word_i|tag_i)
 
-        Structure:
-        [
-            0 (="adj"): {word_i1: count, word_i2: count, ...},
-            1 (="adv"): {word_j1: count, word_j2: count, ...},
-            ...
-        ]
+        Structure: table indexed by word id and tag index, see models/emission.py
+        dense float32 (number of words + 1 x number of tags) array for small vocabularies, compressed sparse rows otherwise
         """
         self.emission_cost = None
 
@@ -74,6 +164,9 @@ class Probabilistic:
             ],
             ...
         ]
+
+        Dense (number of tags x number of tags x number of tags) array, or models.transition.SparseTrigramTable that
+        only stores observed triples if SPARSE_TRIGRAMS is set, use transition_2_lookup to look up either
         """
         self.transition_2_cost = None
 
@@ -82,12 +175,425 @@ class Probabilistic:
         """
         self.beginning_cost = None
 
+        """
+        Tags each word may have when TAG_DICTIONARY is set, None otherwise. Emission cost of every other tag is inf,
+        so decoders never choose it and only consider the allowed tags
+
+        Structure: boolean (number of words + 1 x number of tags) array, last row is for unknown words
+        """
+        self.tag_dictionary = None
+
         # Hyperparameters
         self.MISSING_WORD_PROBABILITY = 10e-5
         self.MISSING_WORD_COST = -np.log(self.MISSING_WORD_PROBABILITY)
         self.MISSING_EMISSION_COST = -np.log(10e-8)
         self.MISSING_TRANSITION_1_COST = -np.log(10e-12)
         self.MISSING_TRANSITION_2_COST = -np.log(10e-12)
+        # emission table with more cells is stored sparse
+        self.MAX_DENSE_EMISSION_CELLS = 2 ** 24
+        # number of hypotheses kept per word by beam search
+        self.BEAM_WIDTH = 8
+        # beam search drops hypotheses whose cost is more than this above the best one, None keeps BEAM_WIDTH of them
+        self.BEAM_MARGIN = None
+        # dtype of tag, beginning and transition costs, 'float32' or 'float16' make the model smaller
+        self.COST_DTYPE = 'float64'
+        # store only observed triples of transition_2_cost, the dense array has number of tags ** 3 cells
+        self.SPARSE_TRIGRAMS = False
+        # restrict every word to tags it was seen with, see _calculate_tag_dictionary
+        self.TAG_DICTIONARY = False
+        # words seen fewer times than this (and unknown words) may also have any open class tag
+        self.TAG_DICTIONARY_MIN_COUNT = 5
+
+    """
+    Costs depend on hyperparameters (e.g. MISSING_EMISSION_COST or TAG_DICTIONARY), so all derived costs are dropped
+    when one of them changes and derived again from statistics when needed, and cached predictions and emission rows
+    are cleared. Models loaded with load have no statistics, they keep the costs they were saved with
+    """
+
+    def __setattr__(self, name, value):
+        if name.isupper() and self.__dict__.get('statistics') is not None and \
+                (name not in self.__dict__ or self.__dict__[name] != value):
+            self._costs = {}
+            self._clear_caches()
+        object.__setattr__(self, name, value)
+
+    """
+    Calculates all the probabilities required for the model to predict new sentences
+
+    Input
+    X: list of sentences, where each sentence is list of strings
+    y: list of tags associated with X
+    """
+
+    def fit(self, X, y):
+        self.statistics = None
+        self.partial_fit(X, y)
+
+    """
+    Same as fit, but adds X and y to data the model was already fitted on, instead of replacing it
+
+    Input
+    X: list of sentences, where each sentence is list of strings
+    y: list of tags associated with X
+    """
+
+    def partial_fit(self, X, y):
+        if self.statistics is None:
+            self.statistics = Statistics()
+        with self._timer('fit.count'):
+            self.statistics.partial_fit(X, y)
+        self.fit_statistics(self.statistics)
+
+    """
+    Fits model on already counted statistics, e.g. merged from statistics of several parts of a corpus
+
+    Input
+    statistics: models.statistics.Statistics
+    """
+
+    def fit_statistics(self, statistics):
+        self.statistics = statistics
+        self.tagIndex = statistics.tagIndex
+        self.tagValue = {idx: tag for (tag, idx) in self.tagIndex.items()}
+        self.vocabulary = statistics.vocabulary
+
+        # costs are derived again when they are needed
+        self._costs = {}
+        self._clear_caches()
+
+    """
+    Same as fit, but chunks of corpus are counted in parallel by a pool of worker processes
+
+    Input
+    chunks: iterable of (X, y), e.g. pos_data.read_chunks
+    n_jobs: number of worker processes, defaults to number of CPUs
+    """
+
+    def fit_parallel(self, chunks, n_jobs=None):
+        self.fit_statistics(count_parallel(chunks, n_jobs))
+
+    """
+    Predicts tags for each sentence
+
+    Input
+    X: list of sentences, where each sentence is list of strings
+
+    Output
+    list of tags for each sentence
+    """
+
+    def predict(self, X):
+        with self._timer('predict'):
+            return self._cached_predict(X, self._predict)
+
+    """
+    Same as predict, but sentences are grouped into buckets by length and every bucket is decoded together
+    as one 3-D cost tensor, which amortizes the per-sentence overhead across the whole bucket
+
+    Input
+    X: list of sentences, where each sentence is list of strings
+    batch_size: maximum number of sentences decoded together
+
+    Output
+    list of tags for each sentence, in the same order as X
+    """
+
+    def predict_batch(self, X, batch_size=256):
+        with self._timer('predict_batch'):
+            return self._cached_predict(X, lambda X: self._predict_batch(X, batch_size))
+
+    def _predict_batch(self, X, batch_size):
+        result = [None for _ in range(len(X))]
+        for indexes in self._length_buckets(X, batch_size):
+            emission = np.stack([self.emission_matrix(X[i]) for i in indexes])
+            tags = self._decode_batch(emission)
+            for i, sample_tags in zip(indexes, tags):
+                result[i] = [self.tagValue[t] for t in sample_tags]
+        return result
+
+    """
+    Same as predict, but chunks of sentences are tagged in parallel by a pool of worker processes. Fitted arrays are
+    published once through shared memory instead of being sent to workers with every chunk
+
+    Input
+    X: list of sentences, where each sentence is list of strings
+    n_jobs: number of worker processes, defaults to number of CPUs
+    chunk_size: number of sentences sent to a worker at once
+
+    Output
+    list of tags for each sentence, in the same order as X
+    """
+
+    def predict_parallel(self, X, n_jobs=None, chunk_size=256):
+        return parallel.predict(self, X, n_jobs, chunk_size)
+
+    """
+    Turns on caching of predictions. Whole sentences that were already predicted are answered from sentence cache,
+    and emission rows of frequent words are kept in word cache. Both caches evict least recently used entries when
+    full, and are cleared when model is fitted again
+
+    Input
+    sentence_size: maximum number of sentences in cache, 0 turns the cache off
+    word_size: maximum number of words in cache, 0 turns the cache off
+    """
+
+    def enable_cache(self, sentence_size=10000, word_size=10000):
+        self.sentence_cache = LRUCache(sentence_size) if sentence_size > 0 else None
+        self.word_cache = LRUCache(word_size) if word_size > 0 else None
+
+    def disable_cache(self):
+        self.enable_cache(0, 0)
+
+    """
+    Output
+    dict with hits, misses, size and maxsize of each enabled cache
+    """
+
+    def cache_info(self):
+        return {name: cache.info() for (name, cache) in [('sentence', self.sentence_cache), ('word', self.word_cache)]
+                if cache is not None}
+
+    def _clear_caches(self):
+        for cache in [self.sentence_cache, self.word_cache]:
+            if cache is not None:
+                cache.clear()
+
+    """
+    Answers sentences found in sentence cache, and predicts the rest (in the same order) with predict_fn
+    """
+
+    def _cached_predict(self, X, predict_fn):
+        self._count('sentences', len(X))
+        if self.sentence_cache is None:
+            return predict_fn(X)
+
+        params = {k: v for (k, v) in vars(self).items() if k.isupper()}
+        if params != self._cache_params:
+            self.sentence_cache.clear()
+            self._cache_params = params
+
+        keys = [tuple(sample) for sample in X]
+        result = [self.sentence_cache.get(key) for key in keys]
+
+        # sentences repeated within X are predicted once
+        missing = {}
+        for i, tags in enumerate(result):
+            if tags is None:
+                missing.setdefault(keys[i], i)
+        if len(missing) > 0:
+            predicted = dict(zip(missing, predict_fn([X[i] for i in missing.values()])))
+            for key, tags in predicted.items():
+                self.sentence_cache.put(key, tuple(tags))
+            result = [tags if tags is not None else tuple(predicted[key]) for (key, tags) in zip(keys, result)]
+        return [list(tags) for tags in result]
+
+    """
+    Turns on timers of stages of fit and predict (e.g. 'fit.count', 'emission', 'viterbi.fill', 'gibbs.sample')
+    and counters (e.g. 'sentences', 'tokens', 'unknown_tokens', 'gibbs_iterations')
+
+    Input
+    callback: optional function(stage, seconds) called every time a timed stage finishes
+
+    Output
+    models.instrumentation.Instrumentation that accumulates the measurements, see stats
+    """
+
+    def enable_instrumentation(self, callback=None):
+        self.instrumentation = Instrumentation(callback)
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        self.instrumentation = None
+
+    """
+    Output
+    dict of measurements since instrumentation was enabled, with cache statistics if caches are enabled,
+    None if instrumentation is disabled
+    """
+
+    def stats(self):
+        if self.instrumentation is None:
+            return None
+        result = self.instrumentation.snapshot()
+        result['caches'] = self.cache_info()
+        return result
+
+    def _timer(self, stage):
+        if self.instrumentation is None:
+            return NULL_TIMER
+        return self.instrumentation.timer(stage)
+
+    def _count(self, name, n=1):
+        if self.instrumentation is not None:
+            self.instrumentation.count(name, n)
+
+    """
+    Writes fitted model to directory path, see models/storage.py for the format
+
+    Input
+    path: directory, created if it does not exist
+    """
+
+    def save(self, path):
+        storage.save(self, path)
+
+    """
+    Reads model written by save. Large arrays are memory-mapped, so loading is fast and processes loading the same
+    model share them
+
+    Input
+    path: directory written by save
+    mmap_mode: passed to np.load, None reads arrays into memory
+
+    Output
+    model of the same class as the saved one
+    """
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        return storage.load(path, mmap_mode)
+
+    """
+    First order Viterbi decoding over precomputed emission matrices of a batch of sentences of equal length, finds
+    tags with minimum cost start_cost[tag_1] + sum of transition_1_cost and emission costs
+
+    Each step is a min-plus product of the previous row of the dp table with the whole transition matrix,
+    the index of the minimizing previous tag is stored as backpointer so backtracking is a simple walk.
+    Tags with infinite emission cost for every sentence (see tag_dictionary) are left out of the product
+
+    Input
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs,
+              see emission_matrix
+    start_cost: cost of each tag for the first word, e.g. beginning_cost
+
+    Output
+    (number of sentences x number of words) array of tag indexes with minimum cost
+    """
+
+    def _first_order_viterbi(self, emission, start_cost):
+        num_samples, num_words, num_tags = emission.shape
+        tags = np.zeros((num_samples, num_words), dtype=np.intp)
+        if num_words == 0:
+            return tags
+
+        backpointer = np.zeros(emission.shape, dtype=np.intp)
+        cost = start_cost + emission[:, 0]
+
+        # words where some tags are not allowed for any sentence of the batch (see tag_dictionary) only use the
+        # allowed ones; for small batches leaving out the other tags costs more than it saves, so all tags are used
+        partial = np.zeros(num_words, dtype=bool)
+        if self.tag_dictionary is not None and num_samples * num_tags * num_tags >= 4096:
+            allowed = np.any(np.isfinite(emission), axis=0)
+            restricted = ~np.all(allowed, axis=1)
+            # step wi depends on tags of words wi - 1 and wi
+            partial[1:] = restricted[1:] | restricted[:-1]
+
+        # fill the dp table, candidates[s, ti, pti] is the cost of reaching tag ti from previous tag pti
+        samples = np.arange(num_samples)[:, np.newaxis]
+        with self._timer('viterbi.fill'):
+            for wi in range(1, num_words):
+                if not partial[wi]:
+                    candidates = cost[:, np.newaxis, :] + self.transition_1_cost + emission[:, wi, :, np.newaxis]
+                    backpointer[:, wi] = np.argmin(candidates, axis=2)
+                    cost = candidates[samples, np.arange(num_tags), backpointer[:, wi]]
+                    continue
+
+                prev, cur = np.flatnonzero(allowed[wi - 1]), np.flatnonzero(allowed[wi])
+                candidates = (cost[:, np.newaxis, prev] + self.transition_1_cost[cur[:, np.newaxis], prev]
+                              + emission[:, wi, cur, np.newaxis])
+                backpointer[:, wi, cur] = prev[np.argmin(candidates, axis=2)]
+                cost = np.full((num_samples, num_tags), np.inf)
+                cost[:, cur] = np.min(candidates, axis=2)
+
+        # backtrack to get tags that result in minimum cost
+        with self._timer('viterbi.backtrack'):
+            tags[:, -1] = np.argmin(cost, axis=1)
+            for wi in range(num_words - 1, 0, -1):
+                tags[:, wi - 1] = backpointer[samples[:, 0], wi, tags[:, wi]]
+        return tags
+
+    """
+    Beam search decoding of a single sentence, keeps at most BEAM_WIDTH best hypotheses for every prefix of sentence
+    (and none that is more than BEAM_MARGIN worse than the best one), so the cost is O(n * BEAM_WIDTH * T) no matter
+    the order of the model. Hypotheses ending with same tags (as many as order) are recombined, only the best is kept
+
+    Input
+    emission: (number of words x number of tags) matrix of emission costs
+    start_cost: cost of each tag for the first word
+    transition: function(wi, prev_2, prev_1) that returns (number of hypotheses x number of tags) matrix of costs
+                of tags of word wi, given arrays of tags of 2 previous words of every hypothesis (prev_2 is -1 for wi = 1)
+    order: number of previous tags the transition depends on, 1 or 2
+
+    Output
+    list of tag indexes
+    """
+
+    def _beam_search(self, emission, start_cost, transition, order):
+        with self._timer('beam'):
+            return self._beam_search_sentence(emission, start_cost, transition, order)
+
+    def _beam_search_sentence(self, emission, start_cost, transition, order):
+        num_words, num_tags = emission.shape
+
+        # for every word, tag and index of previous hypothesis of every hypothesis kept
+        beam_tags, beam_parents = [], []
+        for wi in range(num_words):
+            if wi == 0:
+                cost = start_cost + emission[0]
+                parent = np.full(num_tags, -1)
+                prev_2, prev_1 = parent, np.arange(num_tags)
+            else:
+                # candidates[h, t] is cost of extending hypothesis h with tag t
+                candidates = cost[:, np.newaxis] + transition(wi, prev_2, prev_1) + emission[wi]
+                cost = candidates.ravel()
+                parent = np.repeat(np.arange(len(prev_1)), num_tags)
+                prev_2, prev_1 = prev_1[parent], np.tile(np.arange(num_tags), len(prev_1))
+
+            # keep best hypotheses, sorted by cost, one for each state
+            by_cost = np.argsort(cost, kind='stable')
+            state = prev_1[by_cost] if order == 1 else (prev_2[by_cost] + 1) * num_tags + prev_1[by_cost]
+            _, first = np.unique(state, return_index=True)
+            keep = by_cost[np.sort(first)][:self.BEAM_WIDTH]
+            if self.BEAM_MARGIN is not None:
+                keep = keep[cost[keep] <= cost[keep[0]] + self.BEAM_MARGIN]
+            # tags not allowed by tag dictionary have infinite cost, the best hypothesis is always kept
+            keep = keep[np.isfinite(cost[keep]) | (keep == keep[0])]
+
+            cost, prev_1, prev_2 = cost[keep], prev_1[keep], prev_2[keep]
+            beam_tags.append(prev_1)
+            beam_parents.append(parent[keep])
+
+        # backtrack from best hypothesis, which is the first one
+        tags = [0 for _ in range(num_words)]
+        h = 0
+        for wi in range(num_words - 1, -1, -1):
+            tags[wi] = int(beam_tags[wi][h])
+            h = beam_parents[wi][h]
+        return tags
+
+    """
+    Groups indexes of sentences by sentence length, every group has at most batch_size sentences
+
+    Input
+    X: list of sentences
+    batch_size: maximum size of a group
+
+    Output
+    list of lists of indexes into X
+    """
+
+    @staticmethod
+    def _length_buckets(X, batch_size):
+        buckets = {}
+        for i, sample in enumerate(X):
+            buckets.setdefault(len(sample), []).append(i)
+
+        batches = []
+        for length in sorted(buckets):
+            indexes = buckets[length]
+            for start in range(0, len(indexes), batch_size):
+                batches.append(indexes[start:start + batch_size])
+        return batches
 
     # Wrapper functions to handle errors and missing values
 
@@ -104,9 +610,10 @@ class Probabilistic:
         if tag >= len(self.tagIndex):
             raise Exception("Invalid tag: {}".format(tag))
 
-        if word in self.emission_cost[tag]:
-            return self.emission_cost[tag][word]
-        return self.MISSING_EMISSION_COST
+        word_id = self.vocabulary.get(word, len(self.vocabulary))
+        if self.tag_dictionary is not None and not self.tag_dictionary[word_id, tag]:
+            return float(np.inf)
+        return self.emission_cost.get(word_id, tag)
 
     """
     Input
@@ -143,139 +650,216 @@ class Probabilistic:
         if tag_i_2 >= len(self.tagIndex):
             raise Exception("Invalid tag: {}".format(tag_i_2))
 
+        if isinstance(self.transition_2_cost, SparseTrigramTable):
+            return self.transition_2_cost.get(tag_i, tag_i_1, tag_i_2)
         return self.transition_2_cost[tag_i][tag_i_1][tag_i_2]
-    # End of Wrapper functions to handle errors and missing values
 
     """
-    Finds all the unique tags from given list and generates 2 dictionaries: tag->index, index->tag
+    Same as get_transition_2_cost for arrays of tags, works with dense and sparse transition_2_cost
 
     Input
-    y: list of tags associated with each sentence in training set
+    tag_i, tag_i_1, tag_i_2: arrays (or integers) of tag indexes, broadcast against each other
+
+    Output
+    array of transition costs of the broadcast shape
     """
 
-    def _fetch_tags(self, y):
-        # Get all unique tags from training dataset and index both ways
-        unique_tags = set()
-        for tags in y:
-            unique_tags.update(tags)
+    def transition_2_lookup(self, tag_i, tag_i_1, tag_i_2):
+        if isinstance(self.transition_2_cost, SparseTrigramTable):
+            return self.transition_2_cost.lookup(tag_i, tag_i_1, tag_i_2)
+        return self.transition_2_cost[tag_i, tag_i_1, tag_i_2]
 
-        self.tagIndex = {tag: idx for (idx, tag) in enumerate(unique_tags)}
-        self.tagValue = {idx: tag for (tag, idx) in self.tagIndex.items()}
+    """
+    Input
+    sentence: list of strings
+
+    Output
+    (len(sentence) x number of tags) matrix of emission costs, row i holds P(sentence[i]|tag) for every tag
+    """
+
+    def emission_matrix(self, sentence):
+        with self._timer('emission'):
+            return self._emission_matrix(sentence)
+
+    def _emission_matrix(self, sentence):
+        if self.word_cache is None:
+            return self.emission_rows(self.word_ids(sentence))
+
+        rows = [self.word_cache.get(word) for word in sentence]
+        missing = [i for (i, row) in enumerate(rows) if row is None]
+        if len(missing) > 0:
+            for i, row in zip(missing, self.emission_rows(self.word_ids([sentence[i] for i in missing]))):
+                rows[i] = row
+                # copy, so that cached row does not keep emission matrix of the whole sentence alive
+                self.word_cache.put(sentence[i], row.copy())
+        return np.array(rows, dtype=np.float32).reshape(len(sentence), len(self.tagIndex))
 
     """
-    Calculates -log(P(tag)) for each tag
+    Input
+    word_ids: array of word ids
 
+    Output
+    (len(word_ids) x number of tags) matrix of emission costs, inf for tags not allowed by tag_dictionary
+    """
+
+    def emission_rows(self, word_ids):
+        rows = self.emission_cost.rows(word_ids)
+        tag_dictionary = self.tag_dictionary
+        if tag_dictionary is None:
+            return rows
+        return np.where(tag_dictionary[word_ids], rows, np.float32(np.inf))
+
+    """
     Input
-    y: list of tags associated with each sentence in training set
+    sentence: list of strings
+
+    Output
+    array of word ids, see vocabulary
     """
 
-    def _calculate_tag_cost(self, y):
-        count = [0 for _ in range(len(self.tagIndex))]
+    def word_ids(self, sentence):
+        unknown = len(self.vocabulary)
+        word_ids = np.fromiter((self.vocabulary.get(word, unknown) for word in sentence), dtype=np.intp,
+                               count=len(sentence))
+        if self.instrumentation is not None:
+            self._count('tokens', len(word_ids))
+            self._count('unknown_tokens', int(np.count_nonzero(word_ids == unknown)))
+        return word_ids
+    # End of Wrapper functions to handle errors and missing values
+
+    """
+    Calculates -log(P(tag)) for each tag
+    """
 
-        # calculate frequency for each word appearing opposite to each tag
-        for tags in y:
-            for tag in tags:
-                count[self.tagIndex[tag]] += 1
+    def _calculate_tag_cost(self):
+        count = self.statistics.tag_count
 
         # calculate probability using sum of frequencies of each tag
         # keep all calculations in log
-        log_total = math.log(sum(count))
-        self.tag_cost = [-(math.log(c) - log_total) for c in count]
+        with np.errstate(divide='ignore'):
+            return (-(np.log(count) - np.log(np.sum(count)))).astype(self.COST_DTYPE)
 
     """
     Calculates negative log of emission probability: -log(P(Observed|Hidden))
 
     In this case, it calculates probablity of some word occuring given some tag, -log(P(word|tag))
-
-    Input
-    X: list of sentences, where each sentence is list of strings
-    y: list of tags associated with X
     """
 
-    def _calculate_emission_cost(self, X, y):
-        self.emission_cost = [{} for _ in range(len(self.tagIndex))]
-
-        # calculate frequency for each word appearing opposite to each tag
-        for idx in range(len(X)):
-            for w, t in zip(X[idx], y[idx]):
-                if w not in self.emission_cost[self.tagIndex[t]]:
-                    self.emission_cost[self.tagIndex[t]][w] = 0
-                self.emission_cost[self.tagIndex[t]][w] += 1
+    def _calculate_emission_cost(self):
+        word_ids = self.statistics.emission_words
+        tag_ids = self.statistics.emission_tags
+        count = self.statistics.emission_count
 
         # calculate probability using sum of frequencies of words for each tag
         # keep all calculations in log
-        for idx in range(len(self.emission_cost)):
-            total = sum(self.emission_cost[idx].values())
-            self.emission_cost[idx] = {
-                k: -(math.log(v) - math.log(total)) for (k, v) in self.emission_cost[idx].items()}
+        total = np.bincount(tag_ids, weights=count, minlength=len(self.tagIndex))
+        costs = -(np.log(count) - np.log(total[tag_ids]))
+
+        return build_emission_table(word_ids, tag_ids, costs, len(self.vocabulary), len(self.tagIndex),
+                                    self.MISSING_EMISSION_COST, self.MAX_DENSE_EMISSION_CELLS)
 
     """
     Calculates negative log of transition probability: -log(P(hidden_t|hidden_t-1))
 
     In this case, it calculates probablity of some tag given previous tag, -log(P(tag_t|tag_t-1))
-
-    Input
-    y: list of tags associated with X
     """
 
-    def _calculate_transition_1_cost(self, y):
-        self.transition_1_cost = np.zeros((len(self.tagIndex), len(self.tagIndex)))
-        for sample in y:
-            for idx in range(1, len(sample)):
-                self.transition_1_cost[self.tagIndex[sample[idx]],
-                                       self.tagIndex[sample[idx - 1]]] += 1
+    def _calculate_transition_1_cost(self):
+        transition_1_cost = self.statistics.bigram_count.astype(np.float64)
 
         # divide by sum to get probabilities
-        total = np.sum(self.transition_1_cost, axis=0)
+        total = np.sum(transition_1_cost, axis=0)
         # to avoid 0/0 errors
         total[total == 0] = np.inf
-        self.transition_1_cost /= total
+        transition_1_cost /= total
 
         # give small probability for missing word, so that while testing if this pair appears the probability of tags decreses but does not become 0
-        self.transition_1_cost[self.transition_1_cost == 0] = self.MISSING_WORD_PROBABILITY
+        transition_1_cost[transition_1_cost == 0] = self.MISSING_WORD_PROBABILITY
 
         # keep calculations in log
-        self.transition_1_cost = -np.log(self.transition_1_cost)
+        return (-np.log(transition_1_cost)).astype(self.COST_DTYPE)
 
     """
     Calculates negative log of transition probability: -log(P(hidden_t|hidden_t-1,hidden_t-2))
 
     In this case, it calculates probablity of some tag given sequence of 2 previous tag, -log(P(tag_t|tag_t-1,tag_t-2))
-
-    Input
-    y: list of tags associated with X
     """
 
-    def _calculate_transition_2_cost(self, y):
-        self.transition_2_cost = np.zeros(
-            (len(self.tagIndex), len(self.tagIndex), len(self.tagIndex)))
-        for sample in y:
-            for idx in range(2, len(sample)):
-                self.transition_2_cost[self.tagIndex[sample[idx]],
-                                       self.tagIndex[sample[idx - 1]], self.tagIndex[sample[idx - 2]]] += 1
+    def _calculate_transition_2_cost(self):
+        if self.SPARSE_TRIGRAMS:
+            return self._calculate_sparse_transition_2_cost()
+
+        num_tags = len(self.tagIndex)
+        statistics = self.statistics
+        transition_2_cost = np.zeros((num_tags,) * 3)
+        transition_2_cost[statistics.trigram_tag_i, statistics.trigram_tag_i_1, statistics.trigram_tag_i_2] = \
+            statistics.trigram_count
 
         # divide by sum to get probabilities
-        total = np.sum(self.transition_2_cost, axis=0)
+        total = np.sum(transition_2_cost, axis=0)
         # to avoid 0/0 errors
         total[total == 0] = np.inf
-        self.transition_2_cost /= total
+        transition_2_cost /= total
 
         # give small probability for missing word, so that while testing if this pair appears the probability of tags decreses but does not become 0
-        self.transition_2_cost[self.transition_2_cost == 0] = self.MISSING_WORD_PROBABILITY
+        transition_2_cost[transition_2_cost == 0] = self.MISSING_WORD_PROBABILITY
 
         # keep calculations in log
-        self.transition_2_cost = -np.log(self.transition_2_cost)
+        return (-np.log(transition_2_cost)).astype(self.COST_DTYPE)
+
+    """
+    Same as _calculate_transition_2_cost, but only keeps costs of observed triples, every other triple gets the cost
+    of MISSING_WORD_PROBABILITY just like in the dense array
+    """
+
+    def _calculate_sparse_transition_2_cost(self):
+        num_tags = len(self.tagIndex)
+        tag_i, tag_i_1, tag_i_2 = self.statistics.trigram_tag_i, self.statistics.trigram_tag_i_1, \
+            self.statistics.trigram_tag_i_2
+        count = self.statistics.trigram_count
+
+        # number of times each pair (tag_i-1, tag_i-2) is followed by any tag
+        pairs = tag_i_1 * num_tags + tag_i_2
+        total = np.bincount(pairs, weights=count, minlength=num_tags * num_tags)
+
+        costs = -np.log(count / total[pairs])
+        return SparseTrigramTable(tag_i, tag_i_1, tag_i_2, costs, num_tags,
+                                  -np.log(self.MISSING_WORD_PROBABILITY), self.COST_DTYPE)
+
+    """
+    Calculates tags allowed for every word. A word is allowed the tags it was seen with in training, and if it was
+    seen fewer than TAG_DICTIONARY_MIN_COUNT times also every open class tag, i.e. every tag seen with a word that
+    occurs only once. Unknown words are allowed open class tags
+    """
+
+    def _calculate_tag_dictionary(self):
+        if not self.TAG_DICTIONARY:
+            return None
+
+        word_ids = self.statistics.emission_words
+        tag_ids = self.statistics.emission_tags
+        num_words, num_tags = len(self.vocabulary), len(self.tagIndex)
+        word_count = np.bincount(word_ids, weights=self.statistics.emission_count, minlength=num_words + 1)
+
+        open_class = np.zeros(num_tags, dtype=bool)
+        open_class[tag_ids[word_count[word_ids] == 1]] = True
+        # without any word seen once, no tag can be ruled out for unknown words
+        if not np.any(open_class):
+            open_class[:] = True
+
+        tag_dictionary = np.zeros((num_words + 1, num_tags), dtype=bool)
+        tag_dictionary[word_ids, tag_ids] = True
+        tag_dictionary[word_count < self.TAG_DICTIONARY_MIN_COUNT] |= open_class
+        return tag_dictionary
 
-    def _calculate_beginning_cost(self, y):
-        self.beginning_cost = np.zeros(len(self.tagIndex))
-        for sample in y:
-            self.beginning_cost[self.tagIndex[sample[0]]] += 1
+    def _calculate_beginning_cost(self):
+        beginning_cost = self.statistics.start_count.astype(np.float64)
 
         # divide by sum to get probabilities
-        self.beginning_cost /= np.sum(self.beginning_cost)
+        beginning_cost /= np.sum(beginning_cost)
 
         # small probability for missing
-        self.beginning_cost[self.beginning_cost == 0] = self.MISSING_WORD_PROBABILITY
+        beginning_cost[beginning_cost == 0] = self.MISSING_WORD_PROBABILITY
 
         # convert to cost
-        self.beginning_cost = -np.log(self.beginning_cost)
+        return (-np.log(beginning_cost)).astype(self.COST_DTYPE)
@@ -1,9 +1,6 @@
 #!/usr/bin/env python3
 
-from functools import reduce
 import numpy as np
-import math
-import random
 
 from models.probabilistic import Probabilistic
 
@@ -20,42 +17,74 @@ class Simple(Probabilistic):
         Probabilistic.__init__(self)
 
     """
-    Calculates all the probabilities required for the model to predict new sentences
+    Calculates best tag for each word of each sentence using P(tag|word) = P(word|tag) * P(tag)
 
     Input
     X: list of sentences, where each sentence is list of strings
-    y: list of tags associated with X
+
+    Output
+    list of tags
     """
 
-    def fit(self, X, y):
-        self._fetch_tags(y)
-        self._calculate_tag_cost(y)
-        self._calculate_emission_cost(X, y)
+    def _predict(self, X):
+        best_tag = self.best_tag
+        result = []
+        with self._timer('lookup'):
+            for sample in X:
+                result.append([self.tagValue[t] for t in best_tag[self.word_ids(sample)]])
+        return result
 
     """
-    Calculates best tag for each word of each sentence using P(tag|word) = P(word|tag) * P(tag)
+    Same as predict, for sentences already converted to word ids
 
     Input
-    X: list of sentences, where each sentence is list of strings
+    word_ids: array of word ids (see Probabilistic.word_ids) of any shape, e.g. concatenated sentences
 
     Output
-    list of tags
+    array of tag indexes of the same shape
     """
 
-    def predict(self, X):
-        result = []
-        for sample in X:
-            tags = []
-            for word in sample:
-                # find tag for word is most likely
-                best_tag = None
-                min_cost = float('inf')
-                for idx in range(len(self.tagIndex)):
-                    # P(tag|word) = P(word|tag) * P(tag)
-                    tag_given_word = self.get_emission_cost(idx, word) + self.tag_cost[idx]
-                    if tag_given_word < min_cost:
-                        best_tag = self.tagValue[idx]
-                        min_cost = tag_given_word
-                tags.append(best_tag)
-            result.append(tags)
-        return result
+    def predict_ids(self, word_ids):
+        return self.best_tag[word_ids]
+
+    """
+    Best tag index for every word id, last one is for unknown words. It only depends on the word, so it is calculated
+    once after fitting, when first needed
+    """
+
+    @property
+    def best_tag(self):
+        if self._costs.get('best_tag') is None:
+            self._costs['best_tag'] = self._calculate_best_tag()
+        return self._costs['best_tag']
+
+    """
+    Calculates tag with minimum -log(P(word|tag) * P(tag)) for every word in vocabulary and for unknown word
+    """
+
+    def _calculate_best_tag(self):
+        tag_cost = np.asarray(self.tag_cost)
+        word_ids = np.arange(len(self.vocabulary) + 1)
+        best_tag = np.empty(len(word_ids), dtype=np.intp)
+
+        # in blocks of words, so that sparse emission table is never expanded whole
+        for start in range(0, len(word_ids), 1 << 16):
+            block = word_ids[start:start + (1 << 16)]
+            best_tag[block] = np.argmin(self.emission_rows(block) + tag_cost, axis=1)
+        return best_tag
+
+    """
+    Same as predict, for a batch of sentences of equal length
+
+    Input
+    emission: (number of sentences x number of words x number of tags) tensor of emission costs
+
+    Output
+    (number of sentences x number of words) array of tag indexes
+    """
+
+    def _decode_batch(self, emission):
+        return np.argmin(emission + np.asarray(self.tag_cost), axis=2)
+
+    def _cost_names(self):
+        return ['tag_cost', 'emission_cost', 'tag_dictionary']
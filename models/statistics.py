@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+
+import numpy as np
+
+
+"""
+Raw counts (sufficient statistics) of a tagged corpus, all the costs of Probabilistic models are derived from them
+
+Counts of different parts of a corpus can be added up with partial_fit and merge, so a model can be updated with new
+data, or trained on shards of a corpus counted in parallel, without counting whole corpus again
+"""
+
+
+class Statistics:
+    def __init__(self):
+        """
+        Index of each tag and word, in order of first appearance, same as Probabilistic.tagIndex and vocabulary
+        """
+        self.tagIndex = {}
+        self.vocabulary = {}
+
+        """
+        Number of times each tag occurs, array of length number of tags
+        """
+        self.tag_count = np.zeros(0, dtype=np.int64)
+
+        """
+        Number of sentences starting with each tag, array of length number of tags
+        """
+        self.start_count = np.zeros(0, dtype=np.int64)
+
+        """
+        Number of times each tag follows other tag, bigram_count[tag_i, tag_i-1], same layout as transition_1_cost
+        """
+        self.bigram_count = np.zeros((0, 0), dtype=np.int64)
+
+        """
+        Number of times each tag follows 2 other tags, as arrays of (tag_i, tag_i-1, tag_i-2, count) sorted by tag_i,
+        then tag_i-1, then tag_i-2, triples that never occur are not stored. Only a small part of the number of tags
+        cubed triples occurs in a corpus
+        """
+        self.trigram_tag_i = np.zeros(0, dtype=np.int64)
+        self.trigram_tag_i_1 = np.zeros(0, dtype=np.int64)
+        self.trigram_tag_i_2 = np.zeros(0, dtype=np.int64)
+        self.trigram_count = np.zeros(0, dtype=np.int64)
+
+        """
+        Number of times each word occurs with each tag, as arrays of (word id, tag id, count) sorted by word id then
+        tag id, pairs that never occur are not stored
+        """
+        self.emission_words = np.zeros(0, dtype=np.int64)
+        self.emission_tags = np.zeros(0, dtype=np.int64)
+        self.emission_count = np.zeros(0, dtype=np.int64)
+
+    """
+    Adds counts of a corpus
+
+    Input
+    X: list of sentences, where each sentence is list of strings
+    y: list of tags associated with X
+    """
+
+    def partial_fit(self, X, y):
+        tags, words = {}, {}
+        word_ids = np.fromiter((words.setdefault(w, len(words)) for w in chain.from_iterable(X)), dtype=np.intp)
+        tag_ids = np.fromiter((tags.setdefault(t, len(tags)) for t in chain.from_iterable(y)), dtype=np.intp,
+                              count=len(word_ids))
+
+        offsets = np.zeros(len(y) + 1, dtype=np.intp)
+        np.cumsum([len(sample) for sample in y], out=offsets[1:])
+
+        self.partial_fit_ids(word_ids, tag_ids, offsets, list(words), list(tags))
+
+    """
+    Adds counts of a corpus cached by pos_cache
+
+    Input
+    corpus: pos_cache.Corpus read in mode 'train'
+    """
+
+    def partial_fit_corpus(self, corpus):
+        self.partial_fit_ids(corpus.word_ids, corpus.tag_ids, corpus.offsets, corpus.words, corpus.tags)
+
+    """
+    Adds counts of a corpus encoded as arrays of ids
+
+    Input
+    word_ids, tag_ids: ids of all tokens of all sentences one after another
+    offsets: index of first token of each sentence, followed by total number of tokens
+    words, tags: lists of strings, word or tag with id i at index i
+    """
+
+    def partial_fit_ids(self, word_ids, tag_ids, offsets, words, tags):
+        word_map, tag_map = self._index(words, tags)
+        word_ids, tag_ids = word_map[word_ids], tag_map[tag_ids]
+        offsets = np.asarray(offsets, dtype=np.intp)
+        num_tags = len(self.tagIndex)
+
+        self.tag_count += np.bincount(tag_ids, minlength=num_tags)
+
+        starts = offsets[:-1][offsets[:-1] < offsets[1:]]
+        self.start_count += np.bincount(tag_ids[starts], minlength=num_tags)
+
+        bigrams = self._tag_ngrams(tag_ids, offsets, 2)
+        self.bigram_count += np.bincount(bigrams[1] * num_tags + bigrams[0],
+                                         minlength=num_tags ** 2).reshape((num_tags,) * 2)
+
+        trigrams = self._tag_ngrams(tag_ids, offsets, 3)
+        self._add_trigrams(trigrams[2], trigrams[1], trigrams[0], np.ones(len(trigrams[0]), dtype=np.int64))
+
+        # pairs are keyed by word_id * T + tag_id
+        pairs, count = np.unique(word_ids * num_tags + tag_ids, return_counts=True)
+        self._add_emission(*np.divmod(pairs, num_tags), count)
+
+    """
+    Adds counts of other statistics to these
+    """
+
+    def merge(self, other):
+        word_map, tag_map = self._index(list(other.vocabulary), list(other.tagIndex))
+        self._add_counts(other, word_map, tag_map, 1)
+
+    """
+    Removes counts of other statistics from these, other has to be counted from a part of the corpus these were
+    counted from. Words and tags whose counts drop to 0 stay indexed
+    """
+
+    def subtract(self, other):
+        word_map, tag_map = self._index(list(other.vocabulary), list(other.tagIndex))
+        self._add_counts(other, word_map, tag_map, -1)
+
+    def copy(self):
+        result = Statistics()
+        result.merge(self)
+        return result
+
+    def _add_counts(self, other, word_map, tag_map, sign):
+        self.tag_count[tag_map] += sign * other.tag_count
+        self.start_count[tag_map] += sign * other.start_count
+        self.bigram_count[np.ix_(tag_map, tag_map)] += sign * other.bigram_count
+        self._add_trigrams(tag_map[other.trigram_tag_i], tag_map[other.trigram_tag_i_1], tag_map[other.trigram_tag_i_2],
+                           sign * other.trigram_count)
+        self._add_emission(word_map[other.emission_words], tag_map[other.emission_tags], sign * other.emission_count)
+
+    def _add_emission(self, word_ids, tag_ids, count):
+        num_tags = len(self.tagIndex)
+        keys = np.concatenate([self.emission_words * num_tags + self.emission_tags, word_ids * num_tags + tag_ids])
+        pairs, inverse = np.unique(keys, return_inverse=True)
+        total = np.bincount(inverse, weights=np.concatenate([self.emission_count, count]),
+                            minlength=len(pairs)).astype(np.int64)
+
+        # drop pairs that no longer occur
+        pairs, total = pairs[total != 0], total[total != 0]
+        self.emission_words, self.emission_tags = np.divmod(pairs, num_tags)
+        self.emission_count = total
+
+    def _add_trigrams(self, tag_i, tag_i_1, tag_i_2, count):
+        num_tags = len(self.tagIndex)
+        keys = np.concatenate([(self.trigram_tag_i * num_tags + self.trigram_tag_i_1) * num_tags + self.trigram_tag_i_2,
+                               (tag_i * num_tags + tag_i_1) * num_tags + tag_i_2])
+        triples, inverse = np.unique(keys, return_inverse=True)
+        total = np.bincount(inverse, weights=np.concatenate([self.trigram_count, count]),
+                            minlength=len(triples)).astype(np.int64)
+
+        # drop triples that no longer occur
+        triples, total = triples[total != 0], total[total != 0]
+        triples, self.trigram_tag_i_2 = np.divmod(triples, num_tags)
+        self.trigram_tag_i, self.trigram_tag_i_1 = np.divmod(triples, num_tags)
+        self.trigram_count = total
+
+    """
+    Indexes new words and tags, grows count arrays for new tags
+
+    Input
+    words, tags: lists of strings
+
+    Output
+    arrays that map position in words and tags to id in these statistics
+    """
+
+    def _index(self, words, tags):
+        word_map = np.fromiter((self.vocabulary.setdefault(w, len(self.vocabulary)) for w in words),
+                               dtype=np.intp, count=len(words))
+        old_num_tags = len(self.tagIndex)
+        tag_map = np.fromiter((self.tagIndex.setdefault(t, len(self.tagIndex)) for t in tags),
+                              dtype=np.intp, count=len(tags))
+
+        num_tags = len(self.tagIndex)
+        if num_tags > old_num_tags:
+            grow = num_tags - old_num_tags
+            self.tag_count = np.pad(self.tag_count, (0, grow))
+            self.start_count = np.pad(self.start_count, (0, grow))
+            self.bigram_count = np.pad(self.bigram_count, [(0, grow)] * 2)
+
+        return word_map, tag_map
+
+    """
+    Input
+    tag_ids: ids of all tokens of all sentences one after another
+    offsets: index of first token of each sentence, followed by total number of tokens
+    n: length of sequences
+
+    Output
+    list of n arrays, array i holds tag at position i of every sequence of n consecutive tags within a sentence
+    """
+
+    @staticmethod
+    def _tag_ngrams(tag_ids, offsets, n):
+        # position of every token within its sentence
+        lengths = np.diff(offsets)
+        position = np.arange(len(tag_ids)) - np.repeat(offsets[:-1], lengths)
+
+        last = np.flatnonzero(position >= n - 1)
+        return [tag_ids[last - (n - 1) + i] for i in range(n)]
+
+
+def _count_chunk(X, y):
+    statistics = Statistics()
+    statistics.partial_fit(X, y)
+    return statistics
+
+
+"""
+Counts chunks of a corpus in a pool of worker processes and merges their counts
+
+Input
+chunks: iterable of (X, y), e.g. pos_data.read_chunks, consumed lazily so that only a few chunks are in memory
+n_jobs: number of worker processes, defaults to number of CPUs
+
+Output
+Statistics of whole corpus
+"""
+
+
+def count_parallel(chunks, n_jobs=None):
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    result = Statistics()
+    with ProcessPoolExecutor(n_jobs) as pool:
+        pending = deque()
+        for X, y in chunks:
+            pending.append(pool.submit(_count_chunk, X, y))
+            # keep at most 2 chunks per worker in flight
+            if len(pending) >= 2 * n_jobs:
+                result.merge(pending.popleft().result())
+        while pending:
+            result.merge(pending.popleft().result())
+    return result
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import importlib
+import json
+import os
+
+import numpy as np
+
+from models import emission
+from models.transition import SparseTrigramTable
+
+
+"""
+On-disk format of fitted models
+
+Directory layout:
+meta.json          - format version, class of model, tags in order of index, hyperparameters, emission table layout
+words.txt          - vocabulary, word with id i on line i
+<cost>.npy         - one file for each fitted cost array, e.g. transition_1_cost.npy
+<cost>_<name>.npy  - arrays of a cost stored sparse, e.g. transition_2_cost_keys.npy, see models/transition.py
+emission_<name>.npy - arrays of emission table, e.g. emission_table.npy for dense table
+
+Loading memory-maps all arrays read-only, so many processes loading same model share them through page cache
+"""
+
+VERSION = 2
+
+# every cost stored as arrays, a model saves only those of its Probabilistic._cost_names
+COST_ARRAYS = ['tag_cost', 'beginning_cost', 'transition_1_cost', 'transition_2_cost', 'tag_dictionary']
+
+
+"""
+Input
+model: fitted Probabilistic model
+path: directory to write model to, created if it does not exist
+"""
+
+
+def save(model, path):
+    os.makedirs(path, exist_ok=True)
+    table = model.emission_cost
+    names = [name for name in COST_ARRAYS if name in model._cost_names()]
+
+    meta = {
+        'version': VERSION,
+        'module': type(model).__module__,
+        'class': type(model).__name__,
+        'tags': [model.tagValue[i] for i in range(len(model.tagValue))],
+        'params': {k: v for (k, v) in vars(model).items() if k.isupper() and _is_json(v)},
+        'emission': {
+            'class': type(table).__name__,
+            'num_words': table.num_words,
+            'missing_cost': float(table.missing_cost),
+            'arrays': [k for (k, v) in vars(table).items() if isinstance(v, np.ndarray)],
+        },
+        'costs': [name for name in names
+                  if getattr(model, name) is not None and not isinstance(getattr(model, name), SparseTrigramTable)],
+        'sparse_costs': {name: {'num_tags': getattr(model, name).num_tags,
+                                'missing_cost': float(getattr(model, name).missing_cost)}
+                         for name in names if isinstance(getattr(model, name), SparseTrigramTable)},
+    }
+
+    for name in meta['costs']:
+        np.save(os.path.join(path, name + '.npy'), np.asarray(getattr(model, name)))
+    for name in meta['sparse_costs']:
+        np.save(os.path.join(path, name + '_keys.npy'), getattr(model, name).keys)
+        np.save(os.path.join(path, name + '_data.npy'), getattr(model, name).data)
+    for name in meta['emission']['arrays']:
+        np.save(os.path.join(path, 'emission_' + name + '.npy'), getattr(table, name))
+
+    with open(os.path.join(path, 'words.txt'), 'w') as f:
+        f.writelines(word + '\n' for (word, _) in sorted(model.vocabulary.items(), key=lambda item: item[1]))
+
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+"""
+Input
+path: directory written by save
+mmap_mode: passed to np.load, None reads arrays into memory
+
+Output
+model of the class it was saved from
+"""
+
+
+def load(path, mmap_mode='r'):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    # version 1 had no sparse costs
+    if meta['version'] not in [1, VERSION]:
+        raise Exception('Unsupported model version {} in {}'.format(meta['version'], path))
+
+    model = getattr(importlib.import_module(meta['module']), meta['class'])()
+    vars(model).update(meta['params'])
+
+    model.tagIndex = {tag: idx for (idx, tag) in enumerate(meta['tags'])}
+    model.tagValue = {idx: tag for (tag, idx) in model.tagIndex.items()}
+
+    for name in meta['costs']:
+        setattr(model, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+    for (name, table_meta) in meta.get('sparse_costs', {}).items():
+        table = SparseTrigramTable.__new__(SparseTrigramTable)
+        table.num_tags = table_meta['num_tags']
+        table.missing_cost = table_meta['missing_cost']
+        table.keys = np.load(os.path.join(path, name + '_keys.npy'), mmap_mode=mmap_mode)
+        table.data = np.load(os.path.join(path, name + '_data.npy'), mmap_mode=mmap_mode)
+        setattr(model, name, table)
+
+    with open(os.path.join(path, 'words.txt')) as f:
+        model.vocabulary = {word: idx for (idx, word) in enumerate(f.read().splitlines())}
+
+    table_meta = meta['emission']
+    table = getattr(emission, table_meta['class']).__new__(getattr(emission, table_meta['class']))
+    table.num_words = table_meta['num_words']
+    table.num_tags = len(meta['tags'])
+    table.missing_cost = table_meta['missing_cost']
+    for name in table_meta['arrays']:
+        setattr(table, name, np.load(os.path.join(path, 'emission_' + name + '.npy'), mmap_mode=mmap_mode))
+    model.emission_cost = table
+
+    return model
+
+
+def _is_json(value):
+    return value is None or isinstance(value, (bool, int, float, str))
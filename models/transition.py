@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+"""
+Sparse storage of second order transition costs -log(P(tag_i|tag_i-1, tag_i-2)), see Probabilistic.transition_2_cost
+
+Only observed triples (tag_i, tag_i-1, tag_i-2) are stored, every other triple has the missing cost. Triples are
+stored as sorted integer keys (tag_i * T + tag_i-1) * T + tag_i-2, so any array of triples is looked up at once with
+searchsorted
+"""
+
+
+class SparseTrigramTable:
+    """
+    Input
+    tag_i, tag_i_1, tag_i_2, costs: arrays describing every observed triple and its cost
+    num_tags: number of tags
+    missing_cost: cost of triples not observed
+    dtype: dtype of stored costs
+    """
+
+    def __init__(self, tag_i, tag_i_1, tag_i_2, costs, num_tags, missing_cost, dtype=np.float64):
+        self.num_tags = num_tags
+        self.missing_cost = missing_cost
+
+        keys = self._keys(tag_i, tag_i_1, tag_i_2)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.data = np.asarray(costs, dtype=dtype)[order]
+
+    """
+    Input
+    tag_i, tag_i_1, tag_i_2: arrays (or integers) of tag indexes, broadcast against each other
+
+    Output
+    array of costs of the broadcast shape
+    """
+
+    def lookup(self, tag_i, tag_i_1, tag_i_2):
+        keys = self._keys(tag_i, tag_i_1, tag_i_2)
+        if len(self.keys) == 0:
+            return np.full(keys.shape, self.missing_cost, dtype=self.data.dtype)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[pos] == keys
+        return np.where(found, self.data[pos], self.data.dtype.type(self.missing_cost))
+
+    def get(self, tag_i, tag_i_1, tag_i_2):
+        return float(self.lookup(tag_i, tag_i_1, tag_i_2))
+
+    """
+    Output
+    dense (number of tags x number of tags x number of tags) array, same layout as dense transition_2_cost
+    """
+
+    def dense(self):
+        result = np.full(self.num_tags ** 3, self.missing_cost, dtype=self.data.dtype)
+        result[self.keys] = self.data
+        return result.reshape(self.num_tags, self.num_tags, self.num_tags)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.data.nbytes
+
+    def _keys(self, tag_i, tag_i_1, tag_i_2):
+        # keys of up to 1290 tags fit in int32, which halves the keys and makes searchsorted faster
+        dtype = np.int32 if self.num_tags ** 3 < 2 ** 31 else np.int64
+        tag_i, tag_i_1, tag_i_2 = (np.asarray(t, dtype=dtype) for t in (tag_i, tag_i_1, tag_i_2))
+        return (tag_i * self.num_tags + tag_i_1) * self.num_tags + tag_i_2
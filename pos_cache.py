@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import json
+import os
+
+import numpy as np
+
+from pos_data import iter_sentences
+
+
+"""
+Pre-tokenized binary cache of a corpus read by pos_data, so that it is parsed only once
+
+Directory layout:
+meta.json   - format version, number of sentences and tokens
+words.txt   - vocabulary, word with id i on line i
+tags.txt    - tags, tag with id i on line i
+words.bin   - int32 word id of every token, sentences one after another
+tags.bin    - int32 tag id of every token (empty for corpus read in mode 'test')
+offsets.bin - int64 index of first token of every sentence, followed by total number of tokens
+
+Loading memory-maps the .bin files, so sentences are zero-copy slices of the arrays
+"""
+
+VERSION = 1
+
+
+class Corpus:
+    def __init__(self, words, tags, word_ids, tag_ids, offsets):
+        """
+        list of strings, word with id i at index i
+        """
+        self.words = words
+
+        """
+        list of strings, tag with id i at index i
+        """
+        self.tags = tags
+
+        """
+        int32 arrays of ids of all tokens, sentence i is word_ids[offsets[i]:offsets[i + 1]]
+        """
+        self.word_ids = word_ids
+        self.tag_ids = tag_ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    """
+    Input
+    i: index of sentence
+
+    Output
+    (word ids, tag ids) of sentence i, tag ids are None if corpus has no tags
+    """
+
+    def sentence(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        if len(self.tag_ids) == 0:
+            return self.word_ids[start:end], None
+        return self.word_ids[start:end], self.tag_ids[start:end]
+
+    """
+    Output
+    corpus in the same form as returned by pos_data.read
+    """
+
+    def to_lists(self):
+        X = [[self.words[w] for w in self.sentence(i)[0]] for i in range(len(self))]
+        if len(self.tag_ids) == 0:
+            return (X,)
+        y = [[self.tags[t] for t in self.sentence(i)[1]] for i in range(len(self))]
+        return (X, y)
+
+
+"""
+Reads file with pos_data.iter_sentences and writes it to cache_dir, see top of file
+
+Input
+filepath, mode, fmt, tag_column: same as pos_data.read
+cache_dir: directory to write cache to, created if it does not exist
+chunk_size: number of tokens buffered in memory before they are written out
+"""
+
+
+def write_cache(filepath, cache_dir, mode='train', fmt='line', tag_column=1, chunk_size=1 << 20):
+    os.makedirs(cache_dir, exist_ok=True)
+    words, tags = {}, {}
+    num_sentences, num_tokens = 0, 0
+
+    with open(os.path.join(cache_dir, 'words.bin'), 'wb') as words_file, \
+            open(os.path.join(cache_dir, 'tags.bin'), 'wb') as tags_file, \
+            open(os.path.join(cache_dir, 'offsets.bin'), 'wb') as offsets_file:
+        word_ids, tag_ids, offsets = [], [], []
+
+        def flush():
+            np.array(word_ids, dtype=np.int32).tofile(words_file)
+            np.array(tag_ids, dtype=np.int32).tofile(tags_file)
+            np.array(offsets, dtype=np.int64).tofile(offsets_file)
+            del word_ids[:], tag_ids[:], offsets[:]
+
+        for sentence in iter_sentences(filepath, mode, fmt, tag_column):
+            sentence_words = sentence[0] if mode == 'train' else sentence
+            offsets.append(num_tokens)
+            word_ids.extend(words.setdefault(w, len(words)) for w in sentence_words)
+            if mode == 'train':
+                tag_ids.extend(tags.setdefault(t, len(tags)) for t in sentence[1])
+            num_sentences += 1
+            num_tokens += len(sentence_words)
+
+            if len(word_ids) >= chunk_size:
+                flush()
+
+        offsets.append(num_tokens)
+        flush()
+
+    for name, index in [('words.txt', words), ('tags.txt', tags)]:
+        with open(os.path.join(cache_dir, name), 'w') as f:
+            f.writelines(value + '\n' for value in index)
+
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump({'version': VERSION, 'num_sentences': num_sentences, 'num_tokens': num_tokens}, f)
+
+
+"""
+Input
+cache_dir: directory written by write_cache
+
+Output
+Corpus with memory-mapped arrays
+"""
+
+
+def load_cache(cache_dir):
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != VERSION:
+        raise Exception('Unsupported cache version {} in {}'.format(meta['version'], cache_dir))
+
+    vocabularies = []
+    for name in ['words.txt', 'tags.txt']:
+        with open(os.path.join(cache_dir, name)) as f:
+            vocabularies.append(f.read().splitlines())
+
+    def load(name, dtype, count):
+        # np.memmap can not map empty files
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(cache_dir, name), dtype=dtype, mode='r', shape=(count,))
+
+    num_tag_ids = meta['num_tokens'] if len(vocabularies[1]) > 0 else 0
+    return Corpus(vocabularies[0], vocabularies[1], load('words.bin', np.int32, meta['num_tokens']),
+                  load('tags.bin', np.int32, num_tag_ids), load('offsets.bin', np.int64, meta['num_sentences'] + 1))
@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
 
-import os
-
 
 """
 mode = 'train':
@@ -47,30 +45,102 @@ list[
     ],
     ...
 ]
+
+
+fmt = 'column':
+Reads file in CoNLL column format instead, one word per line followed by its columns (tag_column selects the column
+that holds tag, mode = 'test' only uses the word), sentences separated by blank lines
+sentence1_word1 column1 column2 ...
+sentence1_word2 column1 column2 ...
+
+sentence2_word1 column1 column2 ...
+...
+
+Raises FileNotFoundError if file does not exist, same as read_chunks and iter_sentences
 """
 
 
-def read(filepath, mode):
+def read(filepath, mode, fmt='line', tag_column=1):
     if mode not in ['train', 'test']:
         raise Exception('Invalid mode {}. Use \'train\' or \'test\''.format(mode))
 
     X, y = [], []
-    if not os.path.exists(filepath):
-        return data
-
-    with open(filepath) as f:
-        for i, line in enumerate(f.readlines()):
-            split = line.lower().split()
-            if mode == 'train':
-                if len(split) % 2 != 0:
-                    raise Exception("Invalid sample on line {}: Number of words and tags do not match".format(i))
-                X.append(split[::2])
-                y.append(split[1::2])
-            elif mode == 'test':
-                X.append(split)
+    for sentence in iter_sentences(filepath, mode, fmt, tag_column):
+        if mode == 'train':
+            X.append(sentence[0])
+            y.append(sentence[1])
+        else:
+            X.append(sentence)
 
     if mode == 'train':
         return (X, y)
     elif mode == 'test':
         return (X,)
     return None
+
+
+"""
+Same as read, but returns a generator of chunks of at most chunk_size sentences, so that whole file is never held
+in memory. Every chunk has the same form as return value of read
+"""
+
+
+def read_chunks(filepath, mode, chunk_size=1000, fmt='line', tag_column=1):
+    X, y = [], []
+    for sentence in iter_sentences(filepath, mode, fmt, tag_column):
+        if mode == 'train':
+            X.append(sentence[0])
+            y.append(sentence[1])
+        else:
+            X.append(sentence)
+
+        if len(X) == chunk_size:
+            yield (X, y) if mode == 'train' else (X,)
+            X, y = [], []
+
+    if len(X) > 0:
+        yield (X, y) if mode == 'train' else (X,)
+
+
+"""
+Generator over sentences of file, reads file line by line
+
+Yields (words, tags) for mode = 'train' and words for mode = 'test', where words and tags are lists of strings
+"""
+
+
+def iter_sentences(filepath, mode, fmt='line', tag_column=1):
+    if mode not in ['train', 'test']:
+        raise Exception('Invalid mode {}. Use \'train\' or \'test\''.format(mode))
+    if fmt not in ['line', 'column']:
+        raise Exception('Invalid format {}. Use \'line\' or \'column\''.format(fmt))
+
+    with open(filepath) as f:
+        if fmt == 'line':
+            for i, line in enumerate(f):
+                split = line.lower().split()
+                if mode == 'train':
+                    if len(split) % 2 != 0:
+                        raise Exception("Invalid sample on line {}: Number of words and tags do not match".format(i))
+                    yield (split[::2], split[1::2])
+                else:
+                    yield split
+            return
+
+        words, tags = [], []
+        for i, line in enumerate(f):
+            split = line.lower().split()
+            if len(split) == 0:
+                if len(words) > 0:
+                    yield (words, tags) if mode == 'train' else words
+                words, tags = [], []
+                continue
+
+            if mode == 'train':
+                if len(split) <= tag_column:
+                    raise Exception("Invalid sample on line {}: Missing tag column {}".format(i, tag_column))
+                tags.append(split[tag_column])
+            words.append(split[0])
+
+        if len(words) > 0:
+            yield (words, tags) if mode == 'train' else words
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+
+import numpy as np
+
+from models.probabilistic import Probabilistic
+
+
+"""
+Tagging server, line-delimited JSON over TCP
+
+Every request is one line with a JSON object, every response is one line with a JSON object carrying the same id.
+Responses on one connection may come in different order than requests.
+
+{"id": 1, "tokens": ["the", "dog", "barks"]}  ->  {"id": 1, "tags": ["det", "noun", "verb"]}
+{"id": 2, "op": "stats"}                       ->  {"id": 2, "stats": {...}}
+anything invalid                               ->  {"id": ..., "error": "..."}
+
+Requests from all connections are collected into micro-batches of at most max_batch sentences, waiting at most
+max_wait seconds for a batch to fill up, and every batch is decoded at once with predict_batch.
+At most max_queue sentences wait for decoding, after that reading from connections waits too (backpressure).
+
+Usage:
+./server.py --model path/to/saved/model --port 8765
+"""
+
+
+class MicroBatcher:
+    def __init__(self, model, max_batch=64, max_wait=0.005, max_queue=1024):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue(maxsize=max_queue)
+
+        self.requests = 0
+        self.batches = 0
+        # latencies in seconds of most recent requests, from arriving in queue to being decoded
+        self.latencies = deque(maxlen=10000)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    """
+    Input
+    tokens: list of strings
+
+    Output
+    list of tags, once the batch this sentence is part of is decoded
+    """
+
+    async def submit(self, tokens):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((tokens, future, time.perf_counter()))
+        return await future
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'average_batch_size': self.requests / self.batches if self.batches > 0 else 0.0,
+            'queue_depth': self.queue.qsize(),
+            'max_queue': self.queue.maxsize,
+            'latency_ms': {p: float(np.percentile(latencies, int(p[1:]))) if len(latencies) > 0 else None
+                           for p in ['p50', 'p95', 'p99']},
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # decode in a thread, so that connections keep being served meanwhile
+            try:
+                tags = await loop.run_in_executor(None, self.model.predict_batch, [tokens for (tokens, _, _) in batch])
+            except Exception as e:
+                for (_, future, _) in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            now = time.perf_counter()
+            self.requests += len(batch)
+            self.batches += 1
+            for (_, future, arrived), sample_tags in zip(batch, tags):
+                self.latencies.append(now - arrived)
+                if not future.done():
+                    future.set_result(sample_tags)
+
+
+"""
+Starts listening, returns asyncio.Server; use port 0 to pick any free port (see server.sockets[0].getsockname())
+"""
+
+
+async def start_server(model, host='127.0.0.1', port=8765, max_batch=64, max_wait=0.005, max_queue=1024):
+    batcher = MicroBatcher(model, max_batch, max_wait, max_queue)
+    batcher.start()
+
+    async def handle(request):
+        request_id = request.get('id') if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict):
+                raise Exception('Request must be a JSON object')
+            if request.get('op') == 'stats':
+                return {'id': request_id, 'stats': batcher.stats()}
+            tokens = request.get('tokens')
+            if not isinstance(tokens, list) or not all(isinstance(token, str) for token in tokens):
+                raise Exception('Request must have "tokens": list of strings')
+            return {'id': request_id, 'tags': await batcher.submit(tokens)}
+        except Exception as e:
+            return {'id': request_id, 'error': str(e)}
+
+    async def connection(reader, writer):
+        # bounds number of requests of this connection in flight, reading waits when it is reached
+        in_flight = asyncio.Semaphore(max_queue)
+        pending = set()
+
+        async def respond(request):
+            try:
+                response = await handle(request)
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+            finally:
+                in_flight.release()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    writer.write((json.dumps({'id': None, 'error': 'Invalid JSON: {}'.format(e)}) + '\n').encode())
+                    continue
+
+                await in_flight.acquire()
+                task = asyncio.get_running_loop().create_task(respond(request))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(connection, host, port)
+    server.batcher = batcher
+    return server
+
+
+"""
+Client, sends all sentences over one connection and waits for all responses
+
+Input
+X: list of sentences, where each sentence is list of strings
+
+Output
+list of tags of each sentence
+"""
+
+
+async def tag_remote(X, host='127.0.0.1', port=8765):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        async def send():
+            for (i, sample) in enumerate(X):
+                writer.write((json.dumps({'id': i, 'tokens': sample}) + '\n').encode())
+                await writer.drain()
+
+        sender = asyncio.get_running_loop().create_task(send())
+        result = [None] * len(X)
+        for _ in range(len(X)):
+            response = json.loads(await reader.readline())
+            if 'error' in response:
+                raise Exception('Server error for sentence {}: {}'.format(response['id'], response['error']))
+            result[response['id']] = response['tags']
+        await sender
+        return result
+    finally:
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a saved model over line-delimited JSON on TCP')
+    parser.add_argument('--model', required=True, help='directory written by Probabilistic.save')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch', type=int, default=64, help='maximum number of sentences decoded together')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help='maximum time to wait for a batch to fill')
+    parser.add_argument('--max-queue', type=int, default=1024, help='maximum number of sentences waiting')
+    args = parser.parse_args()
+
+    model = Probabilistic.load(args.model)
+
+    async def run():
+        server = await start_server(model, args.host, args.port, args.max_batch, args.max_wait_ms / 1000,
+                                    args.max_queue)
+        print('Listening on {}:{}'.format(*server.sockets[0].getsockname()[:2]), flush=True)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+from collections import deque
+from itertools import islice
+
+from pos_data import read
+from models import parallel
+from models.probabilistic import Probabilistic
+from models.simple import Simple
+from models.hmm import HMM
+from models.complex import Complex
+
+
+"""
+Tags raw text, one sentence per line with words separated by whitespace, and writes every sentence in the same form
+as training files of pos_data.read: word1 tag1 word2 tag2 ...
+
+Input is read and tagged in chunks by a pool of worker processes, and output is written in input order as soon as
+a chunk is done, so memory use does not depend on size of input and the tagger can be a stage of a Unix pipeline.
+
+Usage:
+./tag.py --model path/to/saved/model < input.txt > tagged.txt
+./tag.py --train data/bc.val --model-type hmm input.txt > tagged.txt
+"""
+
+MODELS = {'simple': Simple, 'hmm': HMM, 'complex': Complex}
+
+
+"""
+Generator of chunks of at most chunk_size lines of f, every line split into words
+"""
+
+
+def read_chunks(f, chunk_size):
+    lines = iter(f)
+    while True:
+        chunk = [line.split() for line in islice(lines, chunk_size)]
+        if not chunk:
+            return
+        yield chunk
+
+
+def format_sentence(words, tags):
+    return ' '.join(word + ' ' + tag for (word, tag) in zip(words, tags))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tag raw text, one sentence per line')
+    parser.add_argument('input', nargs='?', default='-', help='file to tag, - or nothing for stdin')
+    parser.add_argument('--model', help='directory written by Probabilistic.save')
+    parser.add_argument('--train', help='training file to fit a model on instead of loading one')
+    parser.add_argument('--format', default='line', choices=['line', 'column'], help='format of training file')
+    parser.add_argument('--tag-column', type=int, default=1, help='column of tag in training file of column format')
+    parser.add_argument('--model-type', default='hmm', choices=list(MODELS), help='model to fit on training file')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes, default is CPU count')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='number of sentences sent to a worker at once')
+    args = parser.parse_args()
+
+    if (args.model is None) == (args.train is None):
+        parser.error('exactly one of --model and --train is required')
+
+    if args.model is not None:
+        model = Probabilistic.load(args.model)
+    else:
+        model = MODELS[args.model_type]()
+        model.fit(*read(args.train, 'train', args.format, args.tag_column))
+
+    f = sys.stdin if args.input == '-' else open(args.input)
+    try:
+        chunks = read_chunks(f, args.chunk_size)
+
+        # keep chunks read so far, to write original words (model sees them lowercased)
+        pending = deque()
+
+        def lowercase(chunks):
+            for chunk in chunks:
+                pending.append(chunk)
+                yield [[word.lower() for word in words] for words in chunk]
+
+        results = parallel.imap(model, lowercase(chunks), args.jobs)
+        try:
+            for tags in results:
+                chunk = pending.popleft()
+                sys.stdout.writelines(format_sentence(words, sample_tags) + '\n'
+                                      for (words, sample_tags) in zip(chunk, tags))
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # reader of output went away (e.g. head), stop the pool and exit without writing anything else;
+            # output still buffered goes to devnull, so that flushing it at exit does not fail again
+            results.close()
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()